@@ -17,32 +17,59 @@ client is stateless, however server is stateful with maintaining a cache of uplo
 '/status' request headers:
 X-File-Id: fileId
 X-File-Size: fileSize
-return {bytesReceived: int, fileUri: string}
+return {bytesReceived: int, fileUri: string, received: [[start, end], ...], missing: [[start, end], ...]}
 
 '/upload' request headers:
 X-File-Id: fileId
 X-Start-Byte: startByte
-Content-Length: fileSize
+X-File-Size: fileSize (optional, defaults to the size in `X-File-Id`)
+Content-Length: length of the range
 Content-Type: application/octet-stream
-return {fileUri: string, bytesReceived: int}
+return {fileUri: string, bytesReceived: int, missing: [[start, end], ...]}
 
-cached file records:
+A client may split the file into several disjoint ranges and send them concurrently as separate '/upload' requests,
+each written at its `X-Start-Byte`. The server tracks the received ranges (`[start, end)`, end exclusive), '/status'
+reports the missing ones so a resume only sends those, and the request completing the file renames it.
+`bytesReceived` is the length of the received prefix, which keeps the sequential client below working unchanged.
+
+file records, kept in a SQLite registry shared by all workers (`uvicorn fastapi_resumable_upload:app --workers 4`):
 {
     file_id_1: {
         "fileId": str,
         "bytesReceived": int,
         "fileSize": int,
         "fileUri": str,
+        "ranges": [[start, end], ...],
     }
     ...
 }
+
+Dedup mode (`UPLOAD_DEDUP=1`), the client splits the file into chunks and hashes them with SHA-256:
+'/dedup/check' body {chunks: [sha256, ...]}, return {missing: [sha256, ...]}
+'/dedup/chunks/<sha256>' PUT the body of a missing chunk, return {hash: string, size: int}
+'/dedup/assemble' header X-File-Id, body {chunks: [sha256, ...]}, return {fileUri: string, bytesReceived: int}
+Chunks already on the server, from any file or client, are not sent again and are stored once.
+
+A range is recorded once its bytes are written to `<upload_dir>/<fileId>.uploading`. At startup the registry is
+rebuilt from these files, so uploads resume after a restart or a deploy.
 """
 from fastapi import FastAPI, Header, Request, HTTPException
 from starlette.requests import ClientDisconnect
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from typing import Annotated, Union
-import io
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextlib
+import hashlib
 import os
+import sqlite3
+import threading
+import json
+import logging
+import time
+import uuid
+
+from upload_shaper import TooManyUploads, UploadShaper
 
 app = FastAPI()
 
@@ -169,7 +196,392 @@ html_content = """
 """
 # fmt: on
 
-Uploads_Cache = {}
+upload_dir = "/tmp"
+registry_path = os.path.join(upload_dir, "uploads_registry.sqlite3")
+# Record the received range every `checkpoint_bytes` while a request streams in
+checkpoint_bytes = 8 * 1024 * 1024
+# `rebuild` keeps records younger than this even without their file, which the request may not have created yet
+rebuild_grace_seconds = 60.0
+# Request bodies are coalesced into `write_buffer_size` writes, done on `write_threads` threads
+write_buffer_size = 4 * 1024 * 1024
+write_threads = 4
+# Besides one line per request, log the progress of a request every `log_progress_bytes` (at DEBUG level)
+log_progress_bytes = 256 * 1024 * 1024
+# Upload bandwidth in bytes/s, in total and per client, and concurrent '/upload' and '/dedup/chunks' requests per
+# client, 0 is unlimited
+upload_rate_limit = int(os.environ.get("UPLOAD_RATE_LIMIT", 0))
+client_rate_limit = int(os.environ.get("UPLOAD_CLIENT_RATE_LIMIT", 0))
+client_upload_limit = int(os.environ.get("UPLOAD_CLIENT_UPLOAD_LIMIT", 0))
+
+# Dedup mode: the '/dedup/...' endpoints, chunks are stored once in `chunk_dir` by their SHA-256
+dedup_enabled = os.environ.get("UPLOAD_DEDUP", "0") == "1"
+chunk_dir = os.path.join(upload_dir, "chunks")
+chunk_max_size = 64 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+disk_executor = ThreadPoolExecutor(max_workers=write_threads, thread_name_prefix="upload-disk")
+upload_shaper = UploadShaper(upload_rate_limit, client_rate_limit, client_upload_limit)
+
+
+class UploadRegistry:
+    """Records of unfinished uploads in a SQLite database (WAL mode), shared by the worker processes"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS uploads (fileId TEXT PRIMARY KEY, fileUri TEXT NOT NULL, "
+            "fileSize INTEGER NOT NULL, bytesReceived INTEGER NOT NULL, ranges TEXT NOT NULL DEFAULT '[]', "
+            "createdAt REAL NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in self._conn().execute("PRAGMA table_info(uploads)")]
+        if "ranges" not in columns:
+            # Registry from before ranges were tracked, its uploads were received from 0
+            self._conn().execute("ALTER TABLE uploads ADD COLUMN ranges TEXT NOT NULL DEFAULT '[]'")
+            self._conn().execute("UPDATE uploads SET ranges = json_array(json_array(0, bytesReceived))")
+        if "createdAt" not in columns:
+            self._conn().execute("ALTER TABLE uploads ADD COLUMN createdAt REAL NOT NULL DEFAULT 0")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, fileId: str) -> dict | None:
+        row = (
+            self._conn()
+            .execute("SELECT fileId, bytesReceived, fileSize, fileUri, ranges FROM uploads WHERE fileId = ?", (fileId,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return {
+            "fileId": row[0],
+            "bytesReceived": row[1],
+            "fileSize": row[2],
+            "fileUri": row[3],
+            "ranges": json.loads(row[4]),
+        }
+
+    def create(self, uploadFile: dict):
+        """Insert the record unless a concurrent request already did"""
+        self._conn().execute(
+            "INSERT OR IGNORE INTO uploads (fileId, fileUri, fileSize, bytesReceived, ranges, createdAt) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                uploadFile["fileId"],
+                uploadFile["fileUri"],
+                uploadFile["fileSize"],
+                uploadFile["bytesReceived"],
+                json.dumps(uploadFile["ranges"]),
+                time.time(),
+            ),
+        )
+
+    def add_range(self, fileId: str, start: int, end: int) -> dict | None:
+        """Merge `[start, end)` into the received ranges
+
+        Return the updated record, with `complete` set when the ranges cover the whole file. The record of a complete
+        file is deleted in the same transaction, so exactly one request sees it complete and renames the file.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            uploadFile = self.get(fileId)
+            if uploadFile is None:
+                return None
+            uploadFile["ranges"] = _add_range(uploadFile["ranges"], start, end)
+            uploadFile["bytesReceived"] = _received_prefix(uploadFile["ranges"])
+            uploadFile["complete"] = uploadFile["bytesReceived"] >= uploadFile["fileSize"]
+            if uploadFile["complete"]:
+                conn.execute("DELETE FROM uploads WHERE fileId = ?", (fileId,))
+            else:
+                conn.execute(
+                    "UPDATE uploads SET bytesReceived = ?, ranges = ? WHERE fileId = ?",
+                    (uploadFile["bytesReceived"], json.dumps(uploadFile["ranges"]), fileId),
+                )
+        finally:
+            conn.execute("COMMIT")
+        return uploadFile
+
+    def delete(self, fileId: str):
+        self._conn().execute("DELETE FROM uploads WHERE fileId = ?", (fileId,))
+
+    def rebuild(self, directory: str):
+        """Make the records match the `.uploading` files in `directory`
+
+        A file without record, e.g. from before the registry existed, is taken as received from 0 to its size.
+        Records whose file is gone are deleted, unless they are younger than `rebuild_grace_seconds`: a request
+        creates the record before the file. Existing records are kept, so a worker starting while another one already
+        serves uploads loses nothing.
+        """
+        records = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".uploading") and entry.is_file():
+                    fileId = entry.name[: -len(".uploading")]
+                    records.append(_record_from_file(fileId, entry.path, entry.stat().st_size))
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO uploads (fileId, fileUri, fileSize, bytesReceived, ranges) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (r["fileId"], r["fileUri"], r["fileSize"], r["bytesReceived"], json.dumps(r["ranges"]))
+                    for r in records
+                ],
+            )
+            rows = conn.execute(
+                "SELECT fileId, fileUri FROM uploads WHERE createdAt < ?", (time.time() - rebuild_grace_seconds,)
+            ).fetchall()
+            for fileId, fileUri in rows:
+                if not os.path.exists(fileUri):
+                    conn.execute("DELETE FROM uploads WHERE fileId = ?", (fileId,))
+        finally:
+            conn.execute("COMMIT")
+        logger.info("upload registry rebuilt: %d unfinished uploads", len(records))
+
+
+def _record_range(fileId: str, fileUri: str, fileSize: int, startByte: int, start: int, end: int) -> dict:
+    """Add the range `[start, end)` written by a request from `startByte`, return the updated record
+
+    Without a record, the file was either completed by a request for an overlapping range, or its record was
+    deleted meanwhile. Then the record is created again with the range of this request.
+    """
+    uploadFile = uploads_registry.add_range(fileId, start, end)
+    if uploadFile is not None:
+        return uploadFile
+
+    finalUri = os.path.splitext(fileUri)[0]
+    if not os.path.exists(fileUri) and os.path.exists(finalUri):
+        return {"bytesReceived": fileSize, "fileUri": finalUri, "ranges": [[0, fileSize]], "complete": False}
+
+    uploads_registry.create(
+        {"fileId": fileId, "bytesReceived": 0, "fileSize": fileSize, "fileUri": fileUri, "ranges": []}
+    )
+    logger.warning("upload record recreated fileId=%s startByte=%d", fileId, startByte)
+    uploadFile = uploads_registry.add_range(fileId, startByte, end)
+    if uploadFile is None:
+        raise HTTPException(status_code=409, detail={"message": "Upload record removed concurrently, retry"})
+    return uploadFile
+
+
+def _record_from_file(fileId: str, fileUri: str, bytesReceived: int) -> dict:
+    return {
+        "fileId": fileId,
+        "bytesReceived": bytesReceived,
+        "fileSize": _file_size_from_id(fileId) or bytesReceived,
+        "fileUri": fileUri,
+        "ranges": [[0, bytesReceived]] if bytesReceived else [],
+    }
+
+
+def _file_id(request: Request) -> str:
+    """`X-File-Id`, which names files in `upload_dir`, so it must be a plain file name"""
+    fileId = request.headers["X-File-Id"]
+    if not fileId or fileId in (".", "..") or os.path.basename(fileId) != fileId or "\0" in fileId:
+        raise HTTPException(status_code=400, detail={"message": "X-File-Id must be a plain file name"})
+    return fileId
+
+
+def _file_size_from_id(fileId: str) -> int | None:
+    # `X-File-Id` starts with the file size
+    sizePrefix = fileId.split("-", 1)[0]
+    return int(sizePrefix) if sizePrefix.isdigit() else None
+
+
+def _add_range(ranges: list[list[int]], start: int, end: int) -> list[list[int]]:
+    """Insert `[start, end)` into sorted disjoint ranges, merging the ones it overlaps or touches"""
+    if start >= end:
+        return ranges
+    merged = []
+    for r in ranges:
+        if r[1] < start or r[0] > end:
+            merged.append(r)
+        else:
+            start, end = min(start, r[0]), max(end, r[1])
+    merged.append([start, end])
+    return sorted(merged)
+
+
+def _received_prefix(ranges: list[list[int]]) -> int:
+    return ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+
+
+def _missing_ranges(ranges: list[list[int]], fileSize: int) -> list[list[int]]:
+    missing = []
+    position = 0
+    for start, end in ranges:
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < fileSize:
+        missing.append([position, fileSize])
+    return missing
+
+
+uploads_registry = UploadRegistry(registry_path)
+
+
+class RangeWriter:
+    """Write the body of an '/upload' request at its offset without blocking the event loop
+
+    Chunks from `request.stream()` are coalesced in `buffer` and written with `os.pwrite` on `disk_executor` every
+    `buffer_size` bytes. One write is in flight while the next buffer fills, `write` awaits the previous one before
+    submitting, which stops reading the socket when the disk is slower than the network.
+    """
+
+    def __init__(self, fd: int, offset: int, buffer_size: int = write_buffer_size, hasher=None):
+        self.fd = fd
+        # Updated with every write on the disk thread, the writes of a request are in order
+        self.hasher = hasher
+        # File offset of `buffer[0]`
+        self.offset = offset
+        self.buffer = bytearray()
+        # Bytes before this offset are written to the file
+        self.written = offset
+        self.buffer_size = buffer_size
+        self.pending: asyncio.Future | None = None
+
+    async def write(self, chunk: bytes):
+        self.buffer += chunk
+        if len(self.buffer) >= self.buffer_size:
+            await self._submit()
+
+    async def flush(self):
+        if self.buffer:
+            await self._submit()
+        await self._wait()
+
+    async def _submit(self):
+        data, self.buffer = self.buffer, bytearray()
+        await self._wait()
+        self.pending = asyncio.get_running_loop().run_in_executor(
+            disk_executor, _pwrite_all, self.fd, data, self.offset, self.hasher
+        )
+        self.offset += len(data)
+
+    async def _wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            await pending
+            self.written = self.offset
+
+
+def _pwrite_all(fd: int, data: bytearray, offset: int, hasher=None):
+    if hasher is not None:
+        hasher.update(data)
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+
+class ChunkStore:
+    """Content-addressed chunks for the dedup mode
+
+    A chunk is stored once at `<directory>/<sha256[:2]>/<sha256>` and indexed in the `chunks` table of the upload
+    registry database. A file is assembled once by concatenating its chunks into
+    `<directory>/files/<digest[:2]>/<digest>`, keyed by the digest of its chunk list and owned by the store, then hard
+    linked to every file with the same content. The assembled copy is read-only, so is every link to it, and a file
+    replaced at a `fileUri` later never changes what the store links.
+
+    All methods block and are called on `disk_executor`.
+    """
+
+    def __init__(self, directory: str, registry: UploadRegistry):
+        self.directory = directory
+        self.registry = registry
+        conn = registry._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+
+    def path(self, hash: str) -> str:
+        return os.path.join(self.directory, hash[:2], hash)
+
+    def missing(self, hashes: list[str]) -> list[str]:
+        """The hashes in `hashes` without a stored chunk, in order and without duplicates"""
+        conn = self.registry._conn()
+        missing = []
+        for hash in dict.fromkeys(hashes):
+            if conn.execute("SELECT 1 FROM chunks WHERE hash = ?", (hash,)).fetchone() is None:
+                missing.append(hash)
+        return missing
+
+    def temp_path(self) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f".{uuid.uuid4().hex}.tmp")
+
+    def put(self, hash: str, tempPath: str):
+        """Move the verified chunk at `tempPath` into the store, a concurrent upload of the same chunk may win"""
+        path = self.path(hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(tempPath)
+        os.replace(tempPath, path)
+        self.registry._conn().execute("INSERT OR IGNORE INTO chunks (hash, size) VALUES (?, ?)", (hash, size))
+
+    def assemble(self, hashes: list[str], fileUri: str) -> int:
+        """Write the concatenation of the chunks to `fileUri`, return its size"""
+        digest = hashlib.sha256("\n".join(hashes).encode()).hexdigest()
+        assembled = os.path.join(self.directory, "files", digest[:2], digest)
+        if not os.path.exists(assembled):
+            # Concurrent assemblies of the same content write their own temporary file, the last rename wins
+            tempPath = self.temp_path()
+            offset = 0
+            with open(tempPath, "wb") as f:
+                for hash in hashes:
+                    with open(self.path(hash), "rb") as chunk:
+                        offset += _copy_file(chunk.fileno(), f.fileno(), offset)
+            os.chmod(tempPath, 0o444)
+            os.makedirs(os.path.dirname(assembled), exist_ok=True)
+            os.replace(tempPath, assembled)
+
+        tempPath = fileUri + ".assembling"
+        with contextlib.suppress(FileNotFoundError):
+            # Left by an interrupted assembly
+            os.remove(tempPath)
+        try:
+            os.link(assembled, tempPath)
+        except OSError:
+            # e.g. across filesystems, copy the assembled file instead
+            with open(assembled, "rb") as src, open(tempPath, "wb") as dst:
+                _copy_file(src.fileno(), dst.fileno(), 0)
+        os.replace(tempPath, fileUri)
+        return os.path.getsize(fileUri)
+
+
+def _copy_file(src: int, dst: int, offset: int) -> int:
+    """Copy the whole `src` to `dst` at `offset` in the kernel, return the bytes copied"""
+    size = os.fstat(src).st_size
+    copied = 0
+    while copied < size:
+        try:
+            n = os.copy_file_range(src, dst, size - copied, copied, offset + copied)
+        except OSError:
+            os.lseek(dst, offset + copied, os.SEEK_SET)
+            n = os.sendfile(dst, src, copied, size - copied)
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _parse_chunk_hashes(body) -> list[str]:
+    hashes = body.get("chunks") if isinstance(body, dict) else None
+    if not isinstance(hashes, list) or not all(
+        isinstance(h, str) and len(h) == 64 and all(c in "0123456789abcdef" for c in h) for h in hashes
+    ):
+        raise HTTPException(status_code=400, detail="chunks must be a list of lowercase hex SHA-256 digests")
+    return hashes
+
+
+chunk_store = ChunkStore(chunk_dir, uploads_registry)
 
 
 class UnicornException(Exception):
@@ -180,6 +592,16 @@ class UnicornException(Exception):
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def startup():
+    uploads_registry.rebuild(upload_dir)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    disk_executor.shutdown(wait=True)
+
+
 @app.exception_handler(UnicornException)
 async def unicorn_exception_handler(request: Request, exc: UnicornException):
     return JSONResponse(
@@ -205,90 +627,212 @@ async def read_upload():
 
 @app.get("/status")
 async def read_status(request: Request):
-    fileId = request.headers["X-File-Id"]
+    fileId = _file_id(request)
     fileSize = int(request.headers["X-File-Size"])
 
-    uploadFile = Uploads_Cache.get(fileId)
+    uploadFile = uploads_registry.get(fileId)
 
     if uploadFile:
-        assert (
-            os.path.getsize(uploadFile["fileUri"]) == uploadFile["bytesReceived"]
-        ), "actual file bytes must match record bytes!"
         return {
             "bytesReceived": uploadFile["bytesReceived"],
             "fileUri": uploadFile["fileUri"],
+            "received": uploadFile["ranges"],
+            "missing": _missing_ranges(uploadFile["ranges"], uploadFile["fileSize"]),
         }
     else:
-        return {"bytesReceived": 0, "fileUri": ""}
+        return {"bytesReceived": 0, "fileUri": "", "received": [], "missing": [[0, fileSize]]}
 
 
-@app.post("/upload")
-async def upload(request: Request):
-    fileId = request.headers["X-File-Id"]
-    startByte = int(request.headers["X-Start-Byte"])
-    uploadfileSize = int(request.headers["Content-Length"])
-    fileSize = uploadfileSize + startByte
+def _check_dedup_enabled():
+    if not dedup_enabled:
+        raise HTTPException(status_code=404, detail="Dedup mode is disabled, set UPLOAD_DEDUP=1")
 
-    # Create a new file
-    if not Uploads_Cache.get(fileId):
-        # fileUri = "/dev/null"
-        # could use a real path instead, e.g.
-        fileUri = os.path.join("/tmp", fileId + ".uploading")
 
-        uploadFile = Uploads_Cache[fileId] = {
-            "fileId": fileId,
-            "bytesReceived": 0,
-            "fileSize": fileSize,
-            "fileUri": fileUri,
-        }
+@app.post("/dedup/check")
+async def dedup_check(request: Request):
+    """Return the chunks of `{"chunks": [sha256, ...]}` the server does not have, only these need to be sent"""
+    _check_dedup_enabled()
+    hashes = _parse_chunk_hashes(await request.json())
+    missing = await asyncio.get_running_loop().run_in_executor(disk_executor, chunk_store.missing, hashes)
+    return {"missing": missing}
 
-        assert startByte == 0, "startByte must be 0"
 
-        fs = io.FileIO(fileUri, "w")
-        print(f"File create: {fileUri}")
-    # Check the size and append to existing one
-    else:
-        uploadFile = Uploads_Cache[fileId]
-        fileUri = uploadFile["fileUri"]
+@app.put("/dedup/chunks/{hash}")
+async def dedup_put_chunk(hash: str, request: Request):
+    """Store one chunk, its body must hash to `hash`"""
+    _check_dedup_enabled()
+    _parse_chunk_hashes({"chunks": [hash]})
+    if int(request.headers.get("Content-Length", 0)) > chunk_max_size:
+        raise HTTPException(status_code=413, detail={"message": "Chunk too large", "chunkMaxSize": chunk_max_size})
+
+    # Shaped like '/upload', so chunks are not a way around the bandwidth and concurrency limits
+    client = request.client.host if request.client else "unknown"
+    try:
+        with upload_shaper.slot(client):
+            return await _dedup_put_chunk(hash, request, client)
+    except TooManyUploads as e:
+        raise HTTPException(status_code=429, detail={"message": str(e)}, headers={"Retry-After": "1"})
+
+
+async def _dedup_put_chunk(hash: str, request: Request, client: str):
+    loop = asyncio.get_running_loop()
+    tempPath = await loop.run_in_executor(disk_executor, chunk_store.temp_path)
+    fd = await loop.run_in_executor(disk_executor, os.open, tempPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    writer = RangeWriter(fd, 0, hasher=hashlib.sha256())
+    stored = False
+    try:
+        async for chunk in request.stream():
+            await upload_shaper.throttle(client, len(chunk))
+            await writer.write(chunk)
+            if writer.offset + len(writer.buffer) > chunk_max_size:
+                raise HTTPException(status_code=413, detail={"message": "Chunk too large"})
+        await writer.flush()
+        if writer.hasher.hexdigest() != hash:
+            raise HTTPException(status_code=400, detail={"message": "Chunk does not match its hash", "hash": hash})
+        await loop.run_in_executor(disk_executor, chunk_store.put, hash, tempPath)
+        stored = True
+    finally:
+        await writer.flush()
+        await loop.run_in_executor(disk_executor, os.close, fd)
+        if not stored:
+            await loop.run_in_executor(disk_executor, os.remove, tempPath)
+    return {"hash": hash, "size": writer.written}
+
+
+@app.post("/dedup/assemble")
+async def dedup_assemble(request: Request):
+    """Assemble the file `X-File-Id` from `{"chunks": [sha256, ...]}`, like the end of an '/upload'"""
+    _check_dedup_enabled()
+    fileId = _file_id(request)
+    hashes = _parse_chunk_hashes(await request.json())
+    loop = asyncio.get_running_loop()
+    missing = await loop.run_in_executor(disk_executor, chunk_store.missing, hashes)
+    if missing:
+        raise HTTPException(status_code=409, detail={"message": "Chunks missing", "missing": missing})
+
+    fileUri = os.path.join(upload_dir, fileId)
+    fileSize = await loop.run_in_executor(disk_executor, chunk_store.assemble, hashes, fileUri)
+    expectedSize = _file_size_from_id(fileId)
+    if expectedSize is not None and expectedSize != fileSize:
+        await loop.run_in_executor(disk_executor, os.remove, fileUri)
+        raise HTTPException(
+            status_code=400, detail={"message": "Chunks do not add up to the file size", "bytesReceived": fileSize}
+        )
+    logger.info("upload assembled fileUri=%s chunks=%d bytes=%d", fileUri, len(hashes), fileSize)
+    return {"bytesReceived": fileSize, "fileUri": fileUri, "missing": []}
 
-        assert uploadFile["bytesReceived"] == startByte, "startByte must match record bytes!"
 
-        fs = io.FileIO(fileUri, "a")
-        print(f"File reopened: {fileUri}")
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    return PlainTextResponse(upload_shaper.render("upload"), media_type="text/plain; version=0.0.4")
 
+
+@app.post("/upload")
+async def upload(request: Request):
+    client = request.client.host if request.client else "unknown"
     try:
-        async for chunk in request.stream():
-            # The last chunk is b""
-            chunk_size = len(chunk)
-            print(f"chunk_size: {chunk_size}")
-            fs.write(chunk)
-            uploadFile["bytesReceived"] += chunk_size
+        with upload_shaper.slot(client):
+            return await _upload(request, client)
+    except TooManyUploads as e:
+        raise HTTPException(status_code=429, detail={"message": str(e)}, headers={"Retry-After": "1"})
 
-        # Remove the file record
-        del Uploads_Cache[fileId]
-        fs.seek(0, os.SEEK_END)
-        actualSize = fs.tell()
-        fs.close()
 
-        assert fileSize == actualSize, "actual file size must match record size!"
+async def _upload(request: Request, client: str):
+    fileId = _file_id(request)
+    startByte = int(request.headers["X-Start-Byte"])
+    uploadfileSize = int(request.headers["Content-Length"])
+    fileSize = int(request.headers.get("X-File-Size", 0)) or _file_size_from_id(fileId) or uploadfileSize + startByte
 
-        # Rename the file
-        uploadFile["fileUri"] = os.path.splitext(fileUri)[0]
-        print(f"renamed file: {fileUri} to {uploadFile['fileUri']}")
-        os.rename(fileUri, uploadFile["fileUri"])
+    if startByte < 0 or startByte + uploadfileSize > fileSize:
+        raise HTTPException(status_code=416, detail={"message": "Range outside of the file", "fileSize": fileSize})
 
-        return {
-            "bytesReceived": uploadFile["bytesReceived"],
-            "fileUri": uploadFile["fileUri"],
-        }
-    except ClientDisconnect as e:
-        print(f"exception: {e}")
+    uploadFile = uploads_registry.get(fileId)
 
+    # Create a new file, concurrent requests for other ranges may be creating it too
+    if not uploadFile:
+        # fileUri = "/dev/null"
+        # could use a real path instead, e.g.
+        fileUri = os.path.join(upload_dir, fileId + ".uploading")
+
+        uploads_registry.create(
+            {
+                "fileId": fileId,
+                "bytesReceived": 0,
+                "fileSize": fileSize,
+                "fileUri": fileUri,
+                "ranges": [],
+            }
+        )
+        uploadFile = uploads_registry.get(fileId)
+        logger.info("upload created fileUri=%s", fileUri)
+
+    fileUri = uploadFile["fileUri"]
+    loop = asyncio.get_running_loop()
+    fd = await loop.run_in_executor(disk_executor, os.open, fileUri, os.O_WRONLY | os.O_CREAT, 0o644)
+
+    # Write the range at its offset, record it once written
+    writer = RangeWriter(fd, startByte)
+    checkpoint = startByte
+    progress = startByte
+    started = time.perf_counter()
+    disconnected = False
+    try:
+        async for chunk in request.stream():
+            await upload_shaper.throttle(client, len(chunk))
+            await writer.write(chunk)
+            if writer.written - checkpoint >= checkpoint_bytes:
+                await loop.run_in_executor(
+                    disk_executor, uploads_registry.add_range, fileId, checkpoint, writer.written
+                )
+                checkpoint = writer.written
+            if writer.written - progress >= log_progress_bytes:
+                progress = writer.written
+                logger.debug("upload progress fileId=%s startByte=%d position=%d", fileId, startByte, progress)
+    except ClientDisconnect:
+        disconnected = True
+    finally:
+        try:
+            await writer.flush()
+        finally:
+            await loop.run_in_executor(disk_executor, os.close, fd)
+
+    position = writer.written
+    seconds = time.perf_counter() - started
+    logger.info(
+        "upload range fileId=%s startByte=%d bytes=%d seconds=%.3f MB/s=%.1f disconnected=%s",
+        fileId,
+        startByte,
+        position - startByte,
+        seconds,
+        (position - startByte) / max(seconds, 1e-9) / 1e6,
+        disconnected,
+    )
+
+    uploadFile = await loop.run_in_executor(
+        disk_executor, _record_range, fileId, fileUri, fileSize, startByte, checkpoint, position
+    )
+
+    if disconnected:
         raise HTTPException(
             status_code=500,
             detail={
                 "message": "File unfinished, stopped at",
                 "startByte": startByte,
                 "bytesReceived": uploadFile["bytesReceived"],
+                "missing": _missing_ranges(uploadFile["ranges"], fileSize),
             },
         )
+
+    if uploadFile["complete"]:
+        assert os.path.getsize(fileUri) == fileSize, "actual file size must match record size!"
+
+        # Rename the file
+        uploadFile["fileUri"] = os.path.splitext(fileUri)[0]
+        logger.info("upload renamed fileUri=%s to %s", fileUri, uploadFile["fileUri"])
+        os.rename(fileUri, uploadFile["fileUri"])
+
+    return {
+        "bytesReceived": uploadFile["bytesReceived"],
+        "fileUri": uploadFile["fileUri"],
+        "missing": _missing_ranges(uploadFile["ranges"], fileSize),
+    }
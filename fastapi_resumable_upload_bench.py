@@ -0,0 +1,133 @@
+"""
+Usage:
+python fastapi_resumable_upload_bench.py --size 4 --clients 1 4 16
+
+Description:
+Load test of the '/upload' write path of `fastapi_resumable_upload.py`.
+
+It starts `uvicorn fastapi_resumable_upload:app` and, for every `--clients` count, uploads one `--size` GiB file split
+into that many disjoint ranges sent concurrently. Meanwhile a poller sends '/status' requests for the file every
+`--poll` ms, which shows how much the uploads stall the event loop. It reports the aggregate MB/s and the p50/p99
+'/status' latency.
+
+Bodies are generated from one random `--chunk` KiB buffer, so the client side needs little memory and CPU. The file is
+written to `upload_dir` of `fastapi_resumable_upload.py` and removed afterwards.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+
+
+async def body(size: int, chunk: bytes):
+    sent = 0
+    while sent < size:
+        data = chunk[: size - sent]
+        sent += len(data)
+        yield data
+
+
+async def upload_range(client: httpx.AsyncClient, fileId: str, start: int, end: int, chunk: bytes) -> dict:
+    r = await client.post(
+        "/upload",
+        content=body(end - start, chunk),
+        headers={
+            "X-File-Id": fileId,
+            "X-Start-Byte": str(start),
+            "Content-Length": str(end - start),
+            "Content-Type": "application/octet-stream",
+        },
+    )
+    assert r.status_code == 200, (r.status_code, r.text)
+    return r.json()
+
+
+async def poll_status(client: httpx.AsyncClient, fileId: str, size: int, interval: float, done: asyncio.Event):
+    latencies = []
+    while not done.is_set():
+        start = time.perf_counter()
+        r = await client.get("/status", headers={"X-File-Id": fileId, "X-File-Size": str(size)})
+        latencies.append(time.perf_counter() - start)
+        assert r.status_code == 200, r.status_code
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def run(base_url: str, clients: int, size: int, chunk: bytes, interval: float) -> tuple[float, list[float]]:
+    fileId = f"{size}-{int(time.time() * 1000)}-bench-{uuid.uuid4().hex}.bin"
+    step = -(-size // clients)
+    ranges = [(start, min(start + step, size)) for start in range(0, size, step)]
+
+    limits = httpx.Limits(max_connections=clients + 1)
+    async with httpx.AsyncClient(base_url=base_url, timeout=600, limits=limits) as client:
+        done = asyncio.Event()
+        poller = asyncio.create_task(poll_status(client, fileId, size, interval, done))
+        start = time.perf_counter()
+        results = await asyncio.gather(*(upload_range(client, fileId, *r, chunk) for r in ranges))
+        elapsed = time.perf_counter() - start
+        done.set()
+        latencies = await poller
+
+    fileUri = next(result["fileUri"] for result in results if not result["missing"])
+    assert os.path.getsize(fileUri) == size
+    os.remove(fileUri)
+    return size / elapsed / 1e6, latencies
+
+
+def percentile(values: list[float], p: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else float("nan")
+    return statistics.quantiles(values, n=100)[int(p) - 1]
+
+
+def wait_ready(base_url: str, proc: subprocess.Popen):
+    for _ in range(100):
+        if proc.poll() is not None:
+            raise RuntimeError("uvicorn exited")
+        try:
+            httpx.get(f"{base_url}/upload.html")
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError("uvicorn did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=float, default=4, help="GiB of the uploaded file")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--chunk", type=int, default=256, help="KiB per body chunk sent by a client")
+    parser.add_argument("--poll", type=float, default=10, help="ms between '/status' requests")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "fastapi_resumable_upload:app", "--port", str(args.port)],
+        cwd=os.path.dirname(os.path.realpath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_ready(base_url, proc)
+        size = int(args.size * 1024**3)
+        chunk = os.urandom(args.chunk * 1024)
+        for clients in args.clients:
+            mbps, latencies = asyncio.run(run(base_url, clients, size, chunk, args.poll / 1000))
+            print(
+                f"clients={clients:<3} {mbps:10.1f} MB/s  /status p50={percentile(latencies, 50) * 1000:7.2f} ms"
+                f"  p99={percentile(latencies, 99) * 1000:7.2f} ms  ({len(latencies)} requests)"
+            )
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,133 @@
 """
 uvicorn fastapi_streaming:app --reload
+
+Range responses of '/stream' are sent by `FileRangeResponse` without a Python generator: the range is read ahead in
+`os.pread` calls of adaptive size off the event loop. uvicorn has no ASGI extension to `sendfile` a range, so no
+zero-copy send happens under it, only a server implementing `pathsend` sends a whole file itself.
+`STREAM_RANGE_RESPONSE=generator` switches back to the `send_bytes_range_requests` generator and
+`STREAM_RANGE_RESPONSE=starlette` to Starlette's `FileResponse`, which `fastapi_streaming_bench.py` compares with.
+
+'/file' and '/stream' answer conditional requests from a cached `os.stat` of the file: `ETag` and `Last-Modified`
+on every response, `304 Not Modified` for `If-None-Match` or `If-Modified-Since`, `If-Range` to resume a download
+only when the file did not change, and a `Cache-Control` policy per file extension.
+
+'/hls/<filename>/index.m3u8' packages a fragmented mp4 as HLS on demand, without re-muxing: the boxes of the file
+are indexed once (cached in `hls_index_dir`), the fragments are grouped into segments of about
+`hls_segment_duration` seconds, and every segment is a byte range of the file (`#EXT-X-MAP` for `ftyp`+`moov`). The
+most requested segments are kept in memory, up to `hls_segment_cache_bytes`.
 """
 
 from typing import Union, BinaryIO, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+import asyncio
+import errno
+import hashlib
+import json
+import math
+import mimetypes
 import os
+import re
+import secrets
+import stat
+import struct
+import time
 
 from fastapi import FastAPI, Query, HTTPException, status
 from fastapi.requests import Request
-from fastapi.responses import StreamingResponse, HTMLResponse, FileResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, FileResponse, Response
 
 FOLDER = os.path.dirname(os.path.realpath(__file__))
+# "file" for `FileRangeResponse`, "generator" for the `send_bytes_range_requests` generator, "starlette" for
+# `FileResponse`
+range_response = os.environ.get("STREAM_RANGE_RESPONSE", "file")
+# Ranges are read in chunks of `read_chunk_min` to `read_chunk_max`
+# bytes, sized so that sending one takes about `read_chunk_target_seconds` at the rate the socket drains
+read_chunk_min = 64 * 1024
+read_chunk_max = 4 * 1024 * 1024
+read_chunk_target_seconds = 0.05
+read_threads = 8
+# A `Range` header with more ranges is ignored, the whole file is sent
+max_ranges = 64
+_byte_range_spec = re.compile(r"([0-9]*)[ \t]*-[ \t]*([0-9]*)")
+
+# A cached `os.stat` is trusted for `stat_cache_ttl` seconds, then revalidated, of at most `stat_cache_size` files
+stat_cache_ttl = 1.0
+stat_cache_size = 4096
+# `Cache-Control` by file extension, playlists change while segments and whole videos do not
+cache_control_default = "public, max-age=86400"
+cache_control_policies = {".m3u8": "no-cache", ".mpd": "no-cache", ".html": "no-cache"}
+
+# HLS packaging of fragmented mp4 files
+hls_segment_duration = 6.0
+hls_index_dir = os.path.join(FOLDER, ".hls-index")
+hls_segment_cache_bytes = 256 * 1024 * 1024
+
+disk_executor = ThreadPoolExecutor(max_workers=read_threads, thread_name_prefix="stream-disk")
+
+
+@dataclass(slots=True)
+class FileStat:
+    size: int
+    mtime: float
+    etag: str
+    last_modified: str
+    checked_at: float
+
+
+class StatCache:
+    """`os.stat` of the served files with their validators, revalidated by mtime
+
+    An entry is reused for `ttl` seconds, then the file is stat'ed again and the validators recomputed only when its
+    inode, size or mtime changed. At most `max_entries` files are kept, least recently used first out.
+    """
+
+    def __init__(self, ttl: float = stat_cache_ttl, max_entries: int = stat_cache_size):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[tuple, FileStat]] = OrderedDict()
+
+    def get(self, path: str) -> FileStat | None:
+        """The stat of the regular file `path`, None if there is none"""
+        now = time.monotonic()
+        entry = self.entries.get(path)
+        if entry is not None and now - entry[1].checked_at < self.ttl:
+            self.entries.move_to_end(path)
+            return entry[1]
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.entries.pop(path, None)
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            self.entries.pop(path, None)
+            return None
+
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if entry is not None and entry[0] == key:
+            entry[1].checked_at = now
+        else:
+            entry = (
+                key,
+                FileStat(
+                    size=st.st_size,
+                    mtime=st.st_mtime,
+                    etag=f'"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"',
+                    last_modified=formatdate(st.st_mtime, usegmt=True),
+                    checked_at=now,
+                ),
+            )
+        self.entries[path] = entry
+        self.entries.move_to_end(path)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry[1]
+
+
+stat_cache = StatCache()
 
 app = FastAPI()
 
@@ -17,14 +135,16 @@ app = FastAPI()
 ############## Video Files #############
 # http://127.0.0.1:8000/file/?filename=2023short.mp4
 @app.get("/file", response_class=FileResponse)
-async def read_file(filename: str = Query(title="resource file path in file system")):
+async def read_file(request: Request, filename: str = Query(title="resource file path in file system")):
     filepath = os.path.join(FOLDER, filename)
-    if not os.path.exists(filepath):
+    file_stat = stat_cache.get(filepath)
+    if file_stat is None:
         raise HTTPException(404, f"{filepath} not found!")
 
     print(f"video_path[{filepath}]")
 
-    return FileResponse(filepath)
+    content_type = mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+    return range_requests_response(request, file_path=filepath, content_type=content_type, file_stat=file_stat)
 
 
 ############### Video Stream #################
@@ -56,18 +176,22 @@ async def stream(
     print(f"{request.headers}")
 
     filepath = os.path.join(FOLDER, filename)
-    if not os.path.exists(filepath):
+    file_stat = stat_cache.get(filepath)
+    if file_stat is None:
         raise HTTPException(404, f"{filepath} not found!")
 
     print(f"video_path[{filepath}]")
 
-    return range_requests_response(request, file_path=filepath, content_type="video/mp4")
+    return range_requests_response(request, file_path=filepath, content_type="video/mp4", file_stat=file_stat)
 
 
-def range_requests_response(request: Request, file_path: str, content_type: str):
-    """Returns StreamingResponse using Range Requests of a given file"""
+def range_requests_response(request: Request, file_path: str, content_type: str, file_stat: FileStat | None = None):
+    """Returns a response to the Range Requests of a given file, `multipart/byteranges` for several ranges"""
 
-    file_size = os.stat(file_path).st_size
+    file_stat = file_stat or stat_cache.get(file_path)
+    if file_stat is None:
+        raise HTTPException(404, f"{file_path} not found!")
+    file_size = file_stat.size
     start = 0
     end = file_size - 1
 
@@ -79,26 +203,195 @@ def range_requests_response(request: Request, file_path: str, content_type: str)
         "content-encoding": "identity",
         "content-length": str(file_size),
         "access-control-expose-headers": (
-            "content-type, accept-ranges, content-length, " "content-range, content-encoding"
+            "content-type, accept-ranges, content-length, " "content-range, content-encoding, etag, last-modified"
         ),
     }
+    validators = {
+        "etag": file_stat.etag,
+        "last-modified": file_stat.last_modified,
+        "cache-control": cache_control_policies.get(os.path.splitext(file_path)[1].lower(), cache_control_default),
+    }
+    headers.update(validators)
+
+    if _not_modified(request, file_stat):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=validators)
 
     status_code = status.HTTP_200_OK
 
     print(f"{start} = {end} {request.headers.get('Range')} {request.headers.get('host')}")
 
-    if range_header is not None:
-        start, end = get_range_header(range_header, file_size)
+    if range_response == "starlette":
+        # Parses `Range` and `If-Range` itself
+        return FileResponse(file_path, headers=validators, media_type=content_type)
+
+    if range_header is not None and not _if_range_matches(request.headers.get("If-Range"), file_stat):
+        # The client's partial copy is outdated, send the whole file
+        range_header = None
+    ranges = get_range_header(range_header, file_size) if range_header is not None else None
+    if ranges is not None and len(ranges) > 1:
+        return MultipartRangeResponse(file_path, ranges, file_size, content_type, headers=headers)
+    if ranges is not None:
+        start, end = ranges[0]
         size = end - start + 1
         headers["content-length"] = str(size)
         headers["content-range"] = f"bytes {start}-{end}/{file_size}"
         status_code = status.HTTP_206_PARTIAL_CONTENT
 
-    return StreamingResponse(
-        send_bytes_range_requests(file_path, start, end),
-        headers=headers,
-        status_code=status_code,
-    )
+    if range_response == "generator":
+        return StreamingResponse(
+            send_bytes_range_requests(file_path, start, end),
+            headers=headers,
+            status_code=status_code,
+        )
+    return FileRangeResponse(file_path, start, end, status_code=status_code, headers=headers)
+
+
+def _not_modified(request: Request, file_stat: FileStat) -> bool:
+    """Whether the client's copy is current (RFC 7232 section 6), `If-Modified-Since` only counts without `ETag`s"""
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        # Weak comparison, the `W/` prefix is ignored
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or file_stat.etag in tags
+
+    if_modified_since = _parse_http_date(request.headers.get("If-Modified-Since"))
+    return if_modified_since is not None and int(file_stat.mtime) <= if_modified_since
+
+
+def _if_range_matches(if_range: str | None, file_stat: FileStat) -> bool:
+    """Whether `Range` applies: no `If-Range`, or it names the current file by strong `ETag` or exact date"""
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == file_stat.etag
+    if if_range.startswith("W/"):
+        return False
+    return _parse_http_date(if_range) == int(file_stat.mtime)
+
+
+def _parse_http_date(value: str | None) -> int | None:
+    if not value:
+        return None
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
+class FileRangeResponse(Response):
+    """Send the bytes `[start, end]` of a file, `start` and `end` are inclusive like in `Content-Range`
+
+    The range is read with `os.pread` on `disk_executor`, see `_send_range`: under uvicorn, which implements neither
+    ASGI extension for sending files, every byte goes through Python. Only a whole file is handed to a server
+    implementing `http.response.pathsend`, to `sendfile` it.
+    """
+
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict[str, str]):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        # (part header, start, end) sent in order, then `trailer`
+        self.parts = [(b"", start, end)]
+        self.trailer = b""
+        self.chunk_size = read_chunk_min
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        start, end = self.parts[0][1], self.parts[-1][2]
+        if scope["method"] == "HEAD" or end < start:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        whole_file = start == 0 and self.status_code == status.HTTP_200_OK
+        if whole_file and "http.response.pathsend" in scope.get("extensions", {}):
+            await send({"type": "http.response.pathsend", "path": self.path})
+            return
+
+        loop = asyncio.get_running_loop()
+        fd = await loop.run_in_executor(disk_executor, _open_for_read, self.path, start, end)
+        try:
+            for i, (header, start, end) in enumerate(self.parts):
+                if header:
+                    await send({"type": "http.response.body", "body": header, "more_body": True})
+                more_body = i + 1 < len(self.parts) or bool(self.trailer)
+                await self._send_range(send, fd, start, end, more_body)
+            if self.trailer:
+                await send({"type": "http.response.body", "body": self.trailer})
+        finally:
+            await loop.run_in_executor(disk_executor, os.close, fd)
+
+    async def _send_range(self, send, fd: int, start: int, end: int, more_body: bool):
+        """Read ahead: the next chunk is read while the current one is sent
+
+        `send` returns once the server's write buffer is below its high-water mark, so its duration is how long the
+        socket takes to drain a chunk. Fast viewers get up to `read_chunk_max` per read, i.e. few thread hops, while
+        slow ones get `read_chunk_min` and hold little memory.
+        """
+        loop = asyncio.get_running_loop()
+        offset = start
+        pending = loop.run_in_executor(disk_executor, os.pread, fd, min(self.chunk_size, end + 1 - offset), offset)
+        try:
+            while pending is not None:
+                data = await pending
+                pending = None
+                if not data:
+                    raise OSError(errno.EIO, f"Unexpected end of {self.path}")
+                offset += len(data)
+                if offset <= end:
+                    size = min(self.chunk_size, end + 1 - offset)
+                    pending = loop.run_in_executor(disk_executor, os.pread, fd, size, offset)
+                sent = time.perf_counter()
+                await send({"type": "http.response.body", "body": data, "more_body": more_body or offset <= end})
+                self._adapt_chunk_size(len(data), time.perf_counter() - sent)
+        finally:
+            # `fd` is closed once the read in flight is done
+            if pending is not None:
+                await asyncio.gather(pending, return_exceptions=True)
+
+    def _adapt_chunk_size(self, size: int, seconds: float):
+        target = size / max(seconds, 1e-6) * read_chunk_target_seconds
+        if target >= self.chunk_size * 2:
+            self.chunk_size = min(self.chunk_size * 2, read_chunk_max)
+        elif target < self.chunk_size / 2:
+            self.chunk_size = max(self.chunk_size // 2, read_chunk_min)
+
+
+class MultipartRangeResponse(FileRangeResponse):
+    """Send several ranges of a file as a `206 multipart/byteranges` body (RFC 7233 appendix A)
+
+    Only the part headers are built in memory, the bytes of every part are streamed like a single range.
+    """
+
+    def __init__(
+        self, path: str, ranges: list[Tuple[int, int]], file_size: int, content_type: str, headers: dict[str, str]
+    ):
+        boundary = secrets.token_hex(16)
+        parts = []
+        for start, end in ranges:
+            # Every boundary but the first one is preceded by CRLF
+            header = (
+                f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n"
+            )
+            parts.append(((b"\r\n" if parts else b"") + header.encode("latin-1"), start, end))
+        trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+        headers = {
+            **headers,
+            "content-type": f"multipart/byteranges; boundary={boundary}",
+            "content-length": str(sum(len(h) + end + 1 - start for h, start, end in parts) + len(trailer)),
+        }
+        super().__init__(
+            path, ranges[0][0], ranges[-1][1], status_code=status.HTTP_206_PARTIAL_CONTENT, headers=headers
+        )
+        self.parts = parts
+        self.trailer = trailer
+
+
+def _open_for_read(path: str, start: int, end: int) -> int:
+    fd = os.open(path, os.O_RDONLY)
+    # Ask for an aggressive read-ahead of the range
+    os.posix_fadvise(fd, start, end - start + 1, os.POSIX_FADV_SEQUENTIAL)
+    return fd
 
 
 # https://github.com/tiangolo/fastapi/issues/1240#issuecomment-1055396884
@@ -116,20 +409,349 @@ def send_bytes_range_requests(file_path: str, start: int, end: int, chunk_size:
             pos = f.tell()
 
 
-def get_range_header(range_header: str, file_size: int) -> Tuple[int, int]:
-    def _invalid_range():
-        return HTTPException(
-            status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+def get_range_header(range_header: str, file_size: int) -> list[Tuple[int, int]] | None:
+    """Parse a `Range` header (RFC 7233 section 2.1), return the inclusive ranges to send, sorted and coalesced
+
+    `bytes=start-end`, `bytes=start-` and `bytes=-suffix`, separated by commas. Ranges which overlap or touch are
+    merged, so no byte is read twice. Return None when the header must be ignored and the whole file sent: another
+    unit than bytes, a syntax error, or more than `max_ranges` ranges. Raise 416 when no range overlaps the file.
+    """
+    unit, sep, range_set = range_header.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        return None
+
+    specs = [spec for spec in (spec.strip() for spec in range_set.split(",")) if spec]
+    if not specs or len(specs) > max_ranges:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = _byte_range_spec.fullmatch(spec)
+        if match is None:
+            return None
+        first, last = match.group(1), match.group(2)
+        if first:
+            start = int(first)
+            end = min(int(last), file_size - 1) if last else file_size - 1
+            if last and int(last) < start:
+                return None
+        elif last:
+            start, end = max(file_size - int(last), 0), file_size - 1
+            if int(last) == 0:
+                continue
+        else:
+            return None
+        if start < file_size:
+            ranges.append((start, end))
+
+    if not ranges:
+        raise HTTPException(
+            status.HTTP_416_RANGE_NOT_SATISFIABLE,
             detail=f"Invalid request range (Range:{range_header!r})",
+            headers={"content-range": f"bytes */{file_size}"},
         )
 
+    ranges.sort()
+    coalesced = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= coalesced[-1][1] + 1:
+            coalesced[-1] = (coalesced[-1][0], max(coalesced[-1][1], end))
+        else:
+            coalesced.append((start, end))
+    return coalesced
+
+
+############### HLS #################
+# http://127.0.0.1:8000/hls/2023short.mp4/index.m3u8, after `ffmpeg -i 2023short.mp4 -c copy -movflags
+# frag_keyframe+empty_moov+default_base_moof 2023short.mp4` fragmented it
+@app.get("/hls/{filename}/index.m3u8")
+async def read_hls_playlist(request: Request, filename: str):
+    filepath, file_stat, index = await _hls_index(filename)
+    headers = {"etag": file_stat.etag, "cache-control": cache_control_policies[".m3u8"]}
+    if _not_modified(request, file_stat):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        f"#EXT-X-TARGETDURATION:{math.ceil(max((d for _, _, d in index.segments), default=0))}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+        '#EXT-X-MAP:URI="init.mp4"',
+    ]
+    for i, (_, _, duration) in enumerate(index.segments):
+        lines.append(f"#EXTINF:{duration:.3f},")
+        lines.append(f"{i}.m4s")
+    lines.append("#EXT-X-ENDLIST")
+    return Response("\n".join(lines) + "\n", media_type="application/vnd.apple.mpegurl", headers=headers)
+
+
+@app.get("/hls/{filename}/init.mp4")
+async def read_hls_init(request: Request, filename: str):
+    filepath, file_stat, index = await _hls_index(filename)
+    return await _hls_bytes_response(request, filepath, file_stat, -1, *index.init)
+
+
+@app.get("/hls/{filename}/{segment}.m4s")
+async def read_hls_segment(request: Request, filename: str, segment: int):
+    filepath, file_stat, index = await _hls_index(filename)
+    if not 0 <= segment < len(index.segments):
+        raise HTTPException(404, f"Segment {segment} of {filename} not found!")
+    start, end, _ = index.segments[segment]
+    return await _hls_bytes_response(request, filepath, file_stat, segment, start, end)
+
+
+@dataclass(slots=True)
+class HlsIndex:
+    etag: str
+    # `[start, end)` of `ftyp` and `moov`
+    init: tuple[int, int]
+    # `[start, end)` and duration in seconds of every segment, each starts with a `moof`
+    segments: list[tuple[int, int, float]]
+
+    def to_json(self) -> str:
+        return json.dumps({"etag": self.etag, "init": self.init, "segments": self.segments})
+
+    @classmethod
+    def from_json(cls, data: str) -> "HlsIndex":
+        obj = json.loads(data)
+        return cls(obj["etag"], tuple(obj["init"]), [tuple(segment) for segment in obj["segments"]])
+
+
+class SegmentCache:
+    """LRU of segment bytes, bounded by their total size"""
+
+    def __init__(self, max_bytes: int = hls_segment_cache_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[tuple, bytes] = OrderedDict()
+
+    def get(self, key: tuple) -> bytes | None:
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key: tuple, data: bytes):
+        if len(data) > self.max_bytes or key in self.entries:
+            return
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+hls_indexes: dict[str, HlsIndex] = {}
+hls_index_builds: dict[str, asyncio.Future] = {}
+segment_cache = SegmentCache()
+
+
+async def _hls_index(filename: str) -> tuple[str, FileStat, HlsIndex]:
+    filepath = os.path.join(FOLDER, filename)
+    file_stat = stat_cache.get(filepath)
+    if file_stat is None:
+        raise HTTPException(404, f"{filepath} not found!")
+
+    index = hls_indexes.get(filepath)
+    if index is None or index.etag != file_stat.etag:
+        # Concurrent requests for a file being indexed wait for the same build
+        build = hls_index_builds.get(filepath)
+        if build is None:
+            build = asyncio.get_running_loop().run_in_executor(disk_executor, _load_hls_index, filepath, file_stat.etag)
+            hls_index_builds[filepath] = build
+        try:
+            index = await build
+        except ValueError as e:
+            raise HTTPException(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, f"{filename} can not be packaged as HLS: {e}")
+        finally:
+            if hls_index_builds.get(filepath) is build:
+                del hls_index_builds[filepath]
+        hls_indexes[filepath] = index
+    return filepath, file_stat, index
+
+
+async def _hls_bytes_response(
+    request: Request, filepath: str, file_stat: FileStat, segment: int, start: int, end: int
+) -> Response:
+    """`[start, end)` of the file, from `segment_cache` when it is there"""
+    # The file's `ETag` with the segment number inside the quotes
+    headers = {"etag": f'{file_stat.etag[:-1]}-{segment}"', "cache-control": cache_control_default}
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None and headers["etag"] in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    key = (filepath, file_stat.etag, segment)
+    data = segment_cache.get(key)
+    if data is None:
+        data = await asyncio.get_running_loop().run_in_executor(disk_executor, _read_range, filepath, start, end)
+        segment_cache.put(key, data)
+    return Response(data, media_type="video/mp4", headers=headers)
+
+
+def _read_range(path: str, start: int, end: int) -> bytes:
+    fd = os.open(path, os.O_RDONLY)
     try:
-        h = range_header.replace("bytes=", "").split("-")
-        start = int(h[0]) if h[0] != "" else 0
-        end = int(h[1]) if h[1] != "" else file_size - 1
-    except ValueError:
-        raise _invalid_range()
-
-    if start > end or start < 0 or end > file_size - 1:
-        raise _invalid_range()
-    return start, end
+        data = os.pread(fd, end - start, start)
+    finally:
+        os.close(fd)
+    if len(data) != end - start:
+        raise OSError(errno.EIO, f"Unexpected end of {path}")
+    return data
+
+
+def _load_hls_index(path: str, etag: str) -> HlsIndex:
+    """The index of `path` from `hls_index_dir`, built and saved there if missing or stale"""
+    cached = hls_index_path(path)
+    try:
+        with open(cached) as f:
+            index = HlsIndex.from_json(f.read())
+        if index.etag == etag:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+
+    index = _build_hls_index(path, etag)
+    os.makedirs(hls_index_dir, exist_ok=True)
+    # Other worker processes may be saving it too
+    temp = f"{cached}.{os.getpid()}.tmp"
+    with open(temp, "w") as f:
+        f.write(index.to_json())
+    os.replace(temp, cached)
+    return index
+
+
+def hls_index_path(path: str) -> str:
+    """Where the index of the media file `path` is cached"""
+    return os.path.join(hls_index_dir, hashlib.sha1(path.encode()).hexdigest() + ".json")
+
+
+def _build_hls_index(path: str, etag: str) -> HlsIndex:
+    """Walk the top-level boxes, parse `moov` and every `moof` of the video track for the fragment durations
+
+    Raise ValueError for a file without fragments: its samples would have to be re-muxed into fragments first.
+    """
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+
+        def read(offset: int, size: int) -> bytes:
+            return os.pread(f.fileno(), size, offset)
+
+        moov_end = None
+        track = None
+        # [start, end, duration in timescale units] of every fragment
+        fragments = []
+        for kind, offset, header, size in _iter_boxes(read, 0, file_size):
+            if kind == b"moov":
+                track = _parse_moov(read(offset + header, size - header))
+                moov_end = offset + size
+            elif kind == b"moof":
+                if track is None:
+                    raise ValueError("moof before moov")
+                duration = _parse_moof(read(offset + header, size - header), track)
+                fragments.append([offset, offset + size, duration])
+            elif kind == b"mdat" and fragments:
+                fragments[-1][1] = offset + size
+
+    if moov_end is None or track is None:
+        raise ValueError("no moov box")
+    if not fragments:
+        raise ValueError("not a fragmented mp4, remux it with `-movflags frag_keyframe+empty_moov+default_base_moof`")
+
+    segments = []
+    target = hls_segment_duration * track["timescale"]
+    for start, end, duration in fragments:
+        if segments and segments[-1][1] == start and segments[-1][2] < target:
+            segments[-1][1] = end
+            segments[-1][2] += duration
+        else:
+            segments.append([start, end, duration])
+    return HlsIndex(
+        etag, (0, moov_end), [(start, end, duration / track["timescale"]) for start, end, duration in segments]
+    )
+
+
+def _iter_boxes(read, start: int, end: int):
+    """Yield `(type, offset, header size, size)` of the boxes in `[start, end)`, `read(offset, size)` reads bytes"""
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack(">I4s", read(offset, 8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", read(offset + 8, 8))[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise ValueError(f"truncated {kind!r} box at {offset}")
+        yield kind, offset, header, size
+        offset += size
+
+
+def _child_boxes(data: bytes) -> dict[bytes, list[bytes]]:
+    """Payloads of the boxes in `data` by type"""
+    children: dict[bytes, list[bytes]] = {}
+
+    def read(offset: int, size: int) -> bytes:
+        return data[offset : offset + size]
+
+    for kind, offset, header, size in _iter_boxes(read, 0, len(data)):
+        children.setdefault(kind, []).append(data[offset + header : offset + size])
+    return children
+
+
+def _parse_moov(moov: bytes) -> dict:
+    """Track ID, timescale and default sample duration of the video track (else the first track)"""
+    boxes = _child_boxes(moov)
+    tracks = []
+    for trak in boxes.get(b"trak", []):
+        trak_boxes = _child_boxes(trak)
+        tkhd = trak_boxes[b"tkhd"][0]
+        track_id = struct.unpack(">I", tkhd[20:24] if tkhd[0] == 1 else tkhd[12:16])[0]
+        mdia = _child_boxes(trak_boxes[b"mdia"][0])
+        mdhd = mdia[b"mdhd"][0]
+        timescale = struct.unpack(">I", mdhd[20:24] if mdhd[0] == 1 else mdhd[12:16])[0]
+        handler = mdia[b"hdlr"][0][8:12]
+        tracks.append({"id": track_id, "timescale": timescale, "handler": handler, "default_duration": 0})
+    if not tracks:
+        raise ValueError("no track in moov")
+
+    track = next((t for t in tracks if t["handler"] == b"vide"), tracks[0])
+    for mvex in boxes.get(b"mvex", []):
+        for trex in _child_boxes(mvex).get(b"trex", []):
+            track_id, _, default_duration = struct.unpack(">III", trex[4:16])
+            if track_id == track["id"]:
+                track["default_duration"] = default_duration
+    return track
+
+
+def _parse_moof(moof: bytes, track: dict) -> int:
+    """Duration of the samples of `track` in a `moof`, in its timescale"""
+    duration = 0
+    for traf in _child_boxes(moof).get(b"traf", []):
+        traf_boxes = _child_boxes(traf)
+        tfhd = traf_boxes[b"tfhd"][0]
+        flags = int.from_bytes(tfhd[1:4], "big")
+        if struct.unpack(">I", tfhd[4:8])[0] != track["id"]:
+            continue
+        default_duration = track["default_duration"]
+        field = 8
+        # base-data-offset, sample-description-index, then default-sample-duration
+        field += 8 if flags & 0x01 else 0
+        field += 4 if flags & 0x02 else 0
+        if flags & 0x08:
+            default_duration = struct.unpack(">I", tfhd[field : field + 4])[0]
+
+        for trun in traf_boxes.get(b"trun", []):
+            flags = int.from_bytes(trun[1:4], "big")
+            sample_count = struct.unpack(">I", trun[4:8])[0]
+            if not flags & 0x100:
+                duration += sample_count * default_duration
+                continue
+            field = 8 + (4 if flags & 0x01 else 0) + (4 if flags & 0x04 else 0)
+            sample_size = 4 * bin(flags & 0xF00).count("1")
+            for i in range(sample_count):
+                offset = field + i * sample_size
+                duration += struct.unpack(">I", trun[offset : offset + 4])[0]
+    return duration
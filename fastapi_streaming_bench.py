@@ -0,0 +1,361 @@
+"""
+Usage:
+python fastapi_streaming_bench.py range --clients 1 8 32 --size 256 --range 4
+python fastapi_streaming_bench.py hls --clients 8 32
+python fastapi_streaming_bench.py sse --clients 10 100
+python fastapi_streaming_bench.py llm --clients 10 100
+python fastapi_streaming_bench.py all --json results.json --baseline previous.json --tolerance 0.2
+
+Description:
+Load tests of the streaming endpoints, local only: every scenario starts its app with uvicorn on 127.0.0.1, and the
+media files are generated on the fly next to the apps and removed afterwards.
+
+- `range`: `--clients` video viewers against '/stream' of `fastapi_streaming.py`, each requesting random `--range`
+  MiB ranges of a `--size` MiB file, for every `STREAM_RANGE_RESPONSE` mode in `--modes`:
+  - `generator`: the `send_bytes_range_requests` generator, 10,000-byte `f.read` calls
+  - `file`: `FileRangeResponse`, read-ahead `os.pread` of adaptive size
+  - `starlette`: Starlette's `FileResponse`, 64 KiB reads through a thread, one at a time
+- `hls`: viewers playing a synthetic fragmented mp4 from '/hls/<filename>/index.m3u8', segment after segment
+- `sse`: subscribers of '/sse' of `fastapi_streaming_sse.py`
+- `llm`: subscribers of '/llm' of `fastapi_streaming_llm.py`
+
+Range and HLS clients repeat their requests for `--duration` seconds. SSE clients subscribe all at once and read
+until the stream ends or `--duration` is over.
+
+For every scenario and client count it reports:
+- throughput: MB/s for media, events/s for SSE
+- time to first byte, p50/p99: of every request for media, of the first event for SSE
+- latency, p50/p99: of every request for media, the gap between consecutive events for SSE
+- CPU per stream: CPU time of the uvicorn process (from `/proc`, Linux only) divided by the requests or subscribers
+
+`--json` writes the results. With `--baseline` (results of an earlier run) the exit status is 1 when a throughput
+dropped, or a p99 grew, by more than `--tolerance`. This is meant for gating regressions on the streaming hot paths.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import statistics
+import struct
+import subprocess
+import sys
+import time
+
+import httpx
+
+FOLDER = os.path.dirname(os.path.realpath(__file__))
+
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime, in clock ticks
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values: list[float], p: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else float("nan")
+    return statistics.quantiles(values, n=100)[p - 1]
+
+
+############### Synthetic media #################
+def write_random_file(path: str, size: int):
+    with open(path, "wb") as f:
+        block = os.urandom(1024 * 1024)
+        written = 0
+        while written < size:
+            written += f.write(block[: size - written])
+
+
+def _box(kind: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def _full_box(kind: bytes, version: int, flags: int, payload: bytes) -> bytes:
+    return _box(kind, bytes([version]) + flags.to_bytes(3, "big") + payload)
+
+
+def write_fragmented_mp4(path: str, seconds: int, bitrate: int, fps: int = 25, fragment_seconds: int = 2):
+    """A fragmented mp4 with one video track of random samples, about `bitrate` bytes/s
+
+    Only the boxes `fastapi_streaming.py` indexes are real, players can not decode it.
+    """
+    timescale = 12800
+    sample_duration = timescale // fps
+    samples = fps * fragment_seconds
+    sample_size = bitrate // fps
+    tkhd = _full_box(b"tkhd", 0, 3, struct.pack(">III", 0, 0, 1) + bytes(68))
+    mdhd = _full_box(b"mdhd", 0, 0, struct.pack(">IIII", 0, 0, timescale, 0) + bytes(4))
+    hdlr = _full_box(b"hdlr", 0, 0, struct.pack(">I4s", 0, b"vide") + bytes(12) + b"video\0")
+    trex = _full_box(b"trex", 0, 0, struct.pack(">IIIII", 1, 1, sample_duration, 0, 0))
+    moov = _box(
+        b"moov",
+        _full_box(b"mvhd", 0, 0, bytes(96)) + _box(b"trak", tkhd + _box(b"mdia", mdhd + hdlr)) + _box(b"mvex", trex),
+    )
+    payload = os.urandom(samples * sample_size)
+    with open(path, "wb") as f:
+        f.write(_box(b"ftyp", b"isom" + struct.pack(">I", 512) + b"isomiso6"))
+        f.write(moov)
+        for i in range(seconds // fragment_seconds):
+            trun = _full_box(b"trun", 0, 0x200, struct.pack(">I", samples) + struct.pack(">I", sample_size) * samples)
+            tfhd = _full_box(b"tfhd", 0, 0x020000, struct.pack(">I", 1))
+            tfdt = _full_box(b"tfdt", 1, 0, struct.pack(">Q", i * samples * sample_duration))
+            mfhd = _full_box(b"mfhd", 0, 0, struct.pack(">I", i + 1))
+            f.write(_box(b"moof", mfhd + _box(b"traf", tfhd + tfdt + trun)))
+            f.write(_box(b"mdat", payload))
+
+
+############### Server #################
+@contextlib.contextmanager
+def serve(module: str, port: int, env: dict[str, str] | None = None, ready_path: str = "/docs"):
+    """Run `uvicorn <module>:app` until the block ends, yield its base URL and pid"""
+    base_url = f"http://127.0.0.1:{port}"
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{module}:app", "--port", str(port), "--log-level", "warning"],
+        cwd=FOLDER,
+        env={**os.environ, **(env or {})},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            if proc.poll() is not None:
+                raise RuntimeError("uvicorn exited")
+            try:
+                httpx.get(f"{base_url}{ready_path}")
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("uvicorn did not start")
+        yield base_url, proc.pid
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+class Stats:
+    """What the clients of one measurement observed"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.events = 0
+        self.requests = 0
+        self.ttfb: list[float] = []
+        self.latency: list[float] = []
+
+    async def get(self, client: httpx.AsyncClient, url: str, expected: int, **kwargs):
+        """One request, its body is read and dropped"""
+        start = time.perf_counter()
+        async with client.stream("GET", url, **kwargs) as r:
+            assert r.status_code == expected, (url, r.status_code)
+            first = True
+            async for chunk in r.aiter_raw():
+                if first:
+                    self.ttfb.append(time.perf_counter() - start)
+                    first = False
+                self.bytes += len(chunk)
+        self.latency.append(time.perf_counter() - start)
+        self.requests += 1
+
+    def result(self, scenario: str, clients: int, elapsed: float, cpu: float, streams: int) -> dict:
+        result = {
+            "scenario": scenario,
+            "clients": clients,
+            "mb_per_s": self.bytes / elapsed / 1e6,
+            "ttfb_p50_ms": percentile(self.ttfb, 50) * 1000,
+            "ttfb_p99_ms": percentile(self.ttfb, 99) * 1000,
+            "latency_p50_ms": percentile(self.latency, 50) * 1000,
+            "latency_p99_ms": percentile(self.latency, 99) * 1000,
+            "cpu_ms_per_stream": cpu / max(streams, 1) * 1000,
+        }
+        if self.events:
+            result["events_per_s"] = self.events / elapsed
+        return result
+
+
+async def measure(base_url: str, pid: int, clients: int, run_client, timeout: float = 60) -> tuple[Stats, float, float]:
+    """Run `clients` concurrent `run_client(client, stats)`, return the stats, seconds and server CPU seconds"""
+    stats = Stats()
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        cpu = cpu_seconds(pid)
+        start = time.perf_counter()
+        await asyncio.gather(*(run_client(client, stats) for _ in range(clients)))
+        return stats, time.perf_counter() - start, cpu_seconds(pid) - cpu
+
+
+############### Scenarios #################
+def bench_range(args) -> list[dict]:
+    filename = f".bench-{os.getpid()}.mp4"
+    path = os.path.join(FOLDER, filename)
+    size = args.size * 1024 * 1024
+    range_size = int(args.range * 1024 * 1024)
+    write_random_file(path, size)
+
+    async def viewer(client: httpx.AsyncClient, stats: Stats):
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            start = random.randrange(0, max(size - range_size, 1))
+            end = min(start + range_size, size) - 1
+            headers = {"Range": f"bytes={start}-{end}"}
+            await stats.get(client, "/stream", 206, params={"filename": filename}, headers=headers)
+
+    results = []
+    try:
+        for mode in args.modes:
+            with serve("fastapi_streaming", args.port, {"STREAM_RANGE_RESPONSE": mode}) as (base_url, pid):
+                for clients in args.clients:
+                    stats, elapsed, cpu = asyncio.run(measure(base_url, pid, clients, viewer))
+                    results.append(stats.result(f"range/{mode}", clients, elapsed, cpu, stats.requests))
+    finally:
+        os.remove(path)
+    return results
+
+
+def bench_hls(args) -> list[dict]:
+    from fastapi_streaming import hls_index_path
+
+    filename = f".bench-{os.getpid()}-hls.mp4"
+    path = os.path.join(FOLDER, filename)
+    write_fragmented_mp4(path, seconds=args.hls_seconds, bitrate=args.hls_bitrate)
+
+    async def viewer(client: httpx.AsyncClient, stats: Stats):
+        deadline = time.perf_counter() + args.duration
+        r = await client.get(f"/hls/{filename}/index.m3u8")
+        assert r.status_code == 200, r.status_code
+        segments = [line for line in r.text.splitlines() if line.endswith(".m4s")]
+        await stats.get(client, f"/hls/{filename}/init.mp4", 200)
+        # Every viewer starts at a random position, like after a seek
+        i = random.randrange(len(segments))
+        while time.perf_counter() < deadline:
+            await stats.get(client, f"/hls/{filename}/{segments[i % len(segments)]}", 200)
+            i += 1
+
+    results = []
+    try:
+        with serve("fastapi_streaming", args.port) as (base_url, pid):
+            for clients in args.clients:
+                stats, elapsed, cpu = asyncio.run(measure(base_url, pid, clients, viewer))
+                results.append(stats.result("hls", clients, elapsed, cpu, stats.requests))
+    finally:
+        os.remove(path)
+        # Only the index of the benchmark video, the cache also holds the indexes of real media
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(hls_index_path(path))
+    return results
+
+
+def bench_sse(args, module: str, path: str, scenario: str) -> list[dict]:
+    async def subscriber(client: httpx.AsyncClient, stats: Stats):
+        deadline = time.perf_counter() + args.duration
+        start = time.perf_counter()
+        last = None
+        async with client.stream("GET", path) as r:
+            assert r.status_code == 200, r.status_code
+            buffer = b""
+            async for chunk in r.aiter_raw():
+                stats.bytes += len(chunk)
+                buffer += chunk
+                # Events end with a blank line, frames without data (`retry:`, heartbeat comments) are not events
+                *events, buffer = buffer.replace(b"\r\n", b"\n").split(b"\n\n")
+                for event in events:
+                    if not event.startswith(b"data:") and b"\ndata:" not in event:
+                        continue
+                    now = time.perf_counter()
+                    if last is None:
+                        stats.ttfb.append(now - start)
+                    else:
+                        stats.latency.append(now - last)
+                    last = now
+                    stats.events += 1
+                if time.perf_counter() > deadline:
+                    break
+        stats.requests += 1
+
+    results = []
+    with serve(module, args.port) as (base_url, pid):
+        for clients in args.clients:
+            stats, elapsed, cpu = asyncio.run(measure(base_url, pid, clients, subscriber, timeout=args.duration + 60))
+            results.append(stats.result(scenario, clients, elapsed, cpu, clients))
+    return results
+
+
+############### Regressions #################
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """Describe every result worse than its baseline by more than `tolerance`"""
+    previous = {(r["scenario"], r["clients"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = previous.get((result["scenario"], result["clients"]))
+        if base is None:
+            continue
+        name = f"{result['scenario']} clients={result['clients']}"
+        key = "events_per_s" if "events_per_s" in result else "mb_per_s"
+        if key in base and result[key] < base[key] * (1 - tolerance):
+            regressions.append(f"{name}: {key} {base[key]:.1f} -> {result[key]:.1f}")
+        for key in ("ttfb_p99_ms", "latency_p99_ms"):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {base[key]:.2f} -> {result[key]:.2f}")
+    return regressions
+
+
+def print_result(result: dict):
+    throughput = (
+        f"{result['events_per_s']:10.1f} ev/s" if "events_per_s" in result else f"{result['mb_per_s']:10.1f} MB/s"
+    )
+    print(
+        f"{result['scenario']:<16} clients={result['clients']:<4} {throughput}"
+        f"  ttfb p50={result['ttfb_p50_ms']:8.2f} p99={result['ttfb_p99_ms']:8.2f} ms"
+        f"  latency p50={result['latency_p50_ms']:8.2f} p99={result['latency_p99_ms']:8.2f} ms"
+        f"  cpu={result['cpu_ms_per_stream']:8.2f} ms/stream"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", nargs="?", default="range", choices=["range", "hls", "sse", "llm", "all"])
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--duration", type=float, default=10, help="seconds per measurement")
+    parser.add_argument("--size", type=int, default=256, help="MiB of the file for range")
+    parser.add_argument("--range", type=float, default=4, help="MiB per Range request")
+    parser.add_argument(
+        "--modes", nargs="+", default=["generator", "starlette", "file"], help="STREAM_RANGE_RESPONSE for range"
+    )
+    parser.add_argument("--hls-seconds", type=int, default=600, help="length of the video for hls")
+    parser.add_argument("--hls-bitrate", type=int, default=500_000, help="bytes/s of the video for hls")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    scenarios = {
+        "range": lambda: bench_range(args),
+        "hls": lambda: bench_hls(args),
+        "sse": lambda: bench_sse(args, "fastapi_streaming_sse", "/sse", "sse"),
+        "llm": lambda: bench_sse(args, "fastapi_streaming_llm", "/llm", "llm"),
+    }
+    results = []
+    for name, run in scenarios.items():
+        if args.scenario in (name, "all"):
+            for result in run():
+                print_result(result)
+                results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
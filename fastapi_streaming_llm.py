@@ -1,19 +1,177 @@
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from json.encoder import encode_basestring_ascii
 import asyncio
-import json
+import itertools
+import time
+
+from prometheus_text import MetricsText
 
 # `uvicorn fastapi_streaming_llm:app --reload`
 app = FastAPI()
 
+# Tokens are coalesced into one event until `flush_interval` seconds after the first one, or `flush_chars`
+# characters of text (counted before JSON escaping, the frame itself may be larger)
+flush_interval = 0.02
+flush_chars = 4096
+# Delay between the tokens of the mock model
+token_interval = 0.5
+
+
 # Mock OpenAPI API token generation
-async def generate_json():
+async def generate_tokens():
     messages = ["Once", " upon", " a", " time", " there", " was", " an", " AI."]
     for word in messages:
-        data = "event: delta" + "\n" + "data:" + json.dumps({"message": word}) + "\n\n"
-        yield data
-        await asyncio.sleep(0.5)
+        yield word
+        await asyncio.sleep(token_interval)
+
+
+class TokenStreamEncoder:
+    """Coalesce tokens into `event: delta` frames, `data:{"message": ...}` with the tokens joined
+
+    The constant prefix and suffix are pre-serialized, only the joined tokens are JSON-escaped, once per frame instead
+    of once per token.
+    """
+
+    prefix = b'event: delta\ndata:{"message": '
+    suffix = b"}\n\n"
+
+    def __init__(self):
+        self.tokens: list[str] = []
+        self.chars = 0
+        self.first_at = 0.0
+
+    def add(self, token: str):
+        if not self.tokens:
+            self.first_at = time.monotonic()
+        self.tokens.append(token)
+        self.chars += len(token)
+
+    def flush_in(self) -> float | None:
+        """Seconds until the buffered tokens must be flushed, None without tokens"""
+        if not self.tokens:
+            return None
+        return max(0.0, self.first_at + flush_interval - time.monotonic())
+
+    def should_flush(self) -> bool:
+        return bool(self.tokens) and (self.chars >= flush_chars or self.flush_in() == 0.0)
+
+    def flush(self) -> bytes:
+        payload = encode_basestring_ascii("".join(self.tokens)).encode("ascii")
+        self.tokens.clear()
+        self.chars = 0
+        return b"".join((self.prefix, payload, self.suffix))
+
+
+class StreamMetrics:
+    """Token and frame counts of the LLM streams served by `/metrics`, plus the token rate of the running ones"""
+
+    def __init__(self):
+        self.ids = itertools.count()
+        self.tokens = 0
+        self.frames = 0
+        self.bytes = 0
+        self.cancelled = 0
+        self.completed = 0
+        # stream id -> [started at, tokens] of the streams in progress
+        self.active: dict[int, list] = {}
+
+    def start(self) -> int:
+        stream_id = next(self.ids)
+        self.active[stream_id] = [time.monotonic(), 0]
+        return stream_id
+
+    def finish(self, stream_id: int, cancelled: bool):
+        self.active.pop(stream_id, None)
+        if cancelled:
+            self.cancelled += 1
+        else:
+            self.completed += 1
+
+    def observe_token(self, stream_id: int):
+        self.tokens += 1
+        self.active[stream_id][1] += 1
+
+    def observe_frame(self, size: int):
+        self.frames += 1
+        self.bytes += size
+
+    def render(self) -> str:
+        text = MetricsText()
+        text.metric("llm_tokens_total", "counter", "Tokens streamed", self.tokens)
+        text.metric("llm_frames_total", "counter", "SSE frames sent, each with one or more tokens", self.frames)
+        text.metric("llm_sent_bytes_total", "counter", "Bytes of the SSE frames", self.bytes)
+        text.metric("llm_streams_completed_total", "counter", "Streams sent to the end", self.completed)
+        text.metric("llm_streams_cancelled_total", "counter", "Streams cancelled by a disconnect", self.cancelled)
+        text.metric("llm_active_streams", "gauge", "Streams in progress", len(self.active))
+        text.rates("llm_stream_tokens_per_second", "Token rate of each stream in progress", "stream", self.active)
+        return text.render()
+
+
+stream_metrics = StreamMetrics()
+
+
+async def _wait_disconnect(request: Request):
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+def _retrieve_exception(task: asyncio.Task):
+    # A task cancelled or given up on in `finally` may still have failed, read its exception so asyncio does not log
+    # "Task exception was never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+async def encode_stream(request: Request, tokens):
+    """Stream the tokens of `tokens` as coalesced frames, cancel it as soon as the client disconnects
+
+    The next token and the disconnect are awaited together, so a disconnect is noticed while waiting for the model,
+    instead of when the next send fails.
+    """
+    encoder = TokenStreamEncoder()
+    stream_id = stream_metrics.start()
+    next_token = asyncio.ensure_future(anext(tokens))
+    disconnect = asyncio.ensure_future(_wait_disconnect(request))
+    disconnect.add_done_callback(_retrieve_exception)
+    cancelled = True
+    try:
+        while True:
+            done, _ = await asyncio.wait(
+                {next_token, disconnect}, timeout=encoder.flush_in(), return_when=asyncio.FIRST_COMPLETED
+            )
+            if disconnect in done:
+                return
+            if next_token in done:
+                try:
+                    encoder.add(next_token.result())
+                except StopAsyncIteration:
+                    break
+                stream_metrics.observe_token(stream_id)
+                next_token = asyncio.ensure_future(anext(tokens))
+            if encoder.should_flush():
+                frame = encoder.flush()
+                stream_metrics.observe_frame(len(frame))
+                yield frame
+        if encoder.tokens:
+            frame = encoder.flush()
+            stream_metrics.observe_frame(len(frame))
+            yield frame
+        cancelled = False
+    finally:
+        # Nothing is awaited here: Starlette may be cancelling this generator already. Cancelling the pending `anext`
+        # raises `CancelledError` in the upstream generator and ends it.
+        stream_metrics.finish(stream_id, cancelled)
+        disconnect.cancel()
+        next_token.add_done_callback(_retrieve_exception)
+        next_token.cancel()
+
 
 @app.get("/llm")
-async def json_stream():
-    return StreamingResponse(generate_json(), media_type="text/event-stream")
+async def json_stream(request: Request):
+    return StreamingResponse(encode_stream(request, generate_tokens()), media_type="text/event-stream")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    return PlainTextResponse(stream_metrics.render(), media_type="text/plain; version=0.0.4")
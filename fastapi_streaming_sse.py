@@ -1,4 +1,4 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
 import asyncio
 import time
@@ -6,15 +6,114 @@ import time
 # `uvicorn fastapi_streaming_sse:app --reload`
 app = FastAPI()
 
-# This function is an async generator that will yield data over time
-async def event_stream():
-    # Simulate an ongoing process (e.g., data generation or model streaming)
-    for i in range(10):
-        # Yield data in the SSE format: "data: <message>\n\n"
-        yield f"data: Message {i}\n\n"
-        await asyncio.sleep(1)  # Simulate delay between messages
+# Events kept for `Last-Event-ID` resume, a subscriber falling further behind is dropped
+ring_capacity = 1024
+# A comment is sent to idle subscribers every `heartbeat_interval` seconds, so proxies keep the connection open
+heartbeat_interval = 15.0
+publish_interval = 1.0
+# Sent first, how long `EventSource` waits before reconnecting, in ms
+retry_ms = 3000
+
+
+class BroadcastHub:
+    """One producer publishes into a ring buffer, every subscriber reads it with its own cursor
+
+    Events are serialized once when published, subscribers only hold the id of the next event they send, so adding
+    subscribers adds neither producer work nor per-event memory. `published` is replaced on every publish and wakes
+    all the waiting subscribers at once.
+    """
+
+    def __init__(self, capacity: int = ring_capacity):
+        self.capacity = capacity
+        self.frames: list[bytes] = [b""] * capacity
+        # Id of the next published event, the buffer holds `[next_id - capacity, next_id)`
+        self.next_id = 0
+        self.published = asyncio.Event()
+        self.subscribers = 0
+        self.dropped = 0
+
+    def publish(self, data: str, event: str | None = None):
+        lines = [f"id: {self.next_id}"]
+        if event:
+            lines.append(f"event: {event}")
+        lines.extend(f"data: {line}" for line in data.split("\n"))
+        self.frames[self.next_id % self.capacity] = ("\n".join(lines) + "\n\n").encode()
+        self.next_id += 1
+        published, self.published = self.published, asyncio.Event()
+        published.set()
+
+    def oldest_id(self) -> int:
+        return max(0, self.next_id - self.capacity)
+
+    async def subscribe(self, last_event_id: int | None = None):
+        """Yield the SSE stream of one subscriber, from after `last_event_id` if it is still buffered, else live
+
+        An id not published yet, e.g. from before a restart reset the ids, also starts live.
+        """
+        if last_event_id is None or last_event_id >= self.next_id:
+            cursor = self.next_id
+        else:
+            cursor = max(last_event_id + 1, self.oldest_id())
+        self.subscribers += 1
+        try:
+            yield f"retry: {retry_ms}\n\n".encode()
+            while True:
+                if cursor < self.oldest_id():
+                    # The events it has not received yet are overwritten, it reconnects with `Last-Event-ID`
+                    self.dropped += 1
+                    return
+                if cursor < self.next_id:
+                    end = self.next_id
+                    yield b"".join(self.frames[i % self.capacity] for i in range(cursor, end))
+                    cursor = end
+                    continue
+                try:
+                    await asyncio.wait_for(self.published.wait(), heartbeat_interval)
+                except asyncio.TimeoutError:
+                    yield b": heartbeat\n\n"
+        finally:
+            self.subscribers -= 1
+
+
+hub = BroadcastHub()
+
+
+# The single producer, e.g. data generation or model streaming
+async def produce_events():
+    i = 0
+    while True:
+        hub.publish(f"Message {i}")
+        i += 1
+        await asyncio.sleep(publish_interval)
+
+
+@app.on_event("startup")
+async def startup():
+    app.state.producer = asyncio.create_task(produce_events())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.producer.cancel()
+
 
 # SSE endpoint that streams data
 @app.get("/sse")
-async def sse():
-    return StreamingResponse(event_stream(), media_type="text/plain")
\ No newline at end of file
+async def sse(request: Request):
+    last_event_id = request.headers.get("Last-Event-ID")
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    return StreamingResponse(
+        hub.subscribe(last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/sse/stats")
+async def sse_stats():
+    return {
+        "subscribers": hub.subscribers,
+        "dropped": hub.dropped,
+        "nextId": hub.next_id,
+        "oldestId": hub.oldest_id(),
+    }
@@ -7,11 +7,23 @@ A file resumable upload server implemented by FastAPI comply with the `tus` resu
 
 [GitHub - tus/tus-resumable-upload-protocol: Open Protocol for Resumable File Uploads](https://github.com/tus/tus-resumable-upload-protocol)
 
+Metadata of uploads is persisted in `files_dir/.meta`, choose the backend by `TUS_METADATA_BACKEND`:
+- `sqlite`(default): SQLite in WAL mode, safe to share between several uvicorn workers, e.g.
+    `uvicorn fastapi_tusd:app --workers 4`
+- `journal`: append-only journal plus compacted snapshot, single worker only
+- `memory`: process-local dict, lost on restart
+
+Upload bytes are stored by the backend chosen by `TUS_STORAGE_BACKEND`:
+- `sharded`(default): `files_dir/ab/cd/<uuid>`, two levels of directories by the first hex digits of the uuid
+- `local`: flat `files_dir/<uuid>`, the layout of earlier versions
+- `s3`: S3-compatible multipart uploads (needs `boto3`), `TUS_S3_ENDPOINT_URL` and `TUS_S3_BUCKET` select the server
+    and bucket, e.g. a local MinIO at `http://127.0.0.1:9000`
 """
+
 from fastapi import FastAPI, Header, Request, HTTPException
 from starlette.requests import ClientDisconnect
-from fastapi.responses import HTMLResponse, JSONResponse, Response
-from typing import Annotated, Union, Any, Hashable
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, Response
+from typing import Annotated, Union, Any, Awaitable, Callable
 import base64
 import hashlib
 from uuid import uuid4
@@ -19,6 +31,23 @@ from datetime import datetime, timedelta
 import json
 import io
 import os
+import zlib
+from urllib.parse import quote
+from dataclasses import dataclass, field
+from collections import OrderedDict
+import errno
+import heapq
+import bisect
+import sqlite3
+import threading
+import time
+import fcntl
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from prometheus_text import MetricsText
+from upload_shaper import TooManyUploads, UploadShaper
 
 app = FastAPI()
 
@@ -53,28 +82,86 @@ html_content = """
 # fmt: on
 
 tus_version = "1.0.0"
-tus_extension = "creation,creation-defer-length,creation-with-upload,expiration,termination"
+tus_extension = "creation,creation-defer-length,creation-with-upload,expiration,termination,checksum,concatenation"
 tus_checksum_algorithm = "md5,sha1,crc32"
 max_size = 128849018880
 location = "http://127.0.0.1:8000/files"
 files_dir = "/tmp/files"
+# Where `FileMetadata` is persisted: "memory", "journal" or "sqlite"
+metadata_backend = os.environ.get("TUS_METADATA_BACKEND", "sqlite")
+metadata_dir = os.path.join(files_dir, ".meta")
+locks_dir = os.path.join(files_dir, ".locks")
+# Batch fsync of the journal: at most one fsync per `metadata_fsync_interval` seconds or `metadata_fsync_batch` records
+metadata_fsync_interval = 1.0
+metadata_fsync_batch = 256
+# Persist the offset while streaming a PATCH body every `metadata_checkpoint_bytes` bytes instead of every chunk
+metadata_checkpoint_bytes = 8 * 1024 * 1024
+storage_backend = os.environ.get("TUS_STORAGE_BACKEND", "sharded")
+# Uploads a worker remembers to exist without asking the storage, least recently used ones are forgotten first
+storage_index_size = 100_000
+s3_endpoint_url = os.environ.get("TUS_S3_ENDPOINT_URL")
+s3_bucket = os.environ.get("TUS_S3_BUCKET", "tus")
+# Completed uploads are read in `download_chunk_size` chunks, only a server implementing the ASGI `pathsend` extension
+# sends a whole file itself (uvicorn does not)
+download_chunk_size = 1024 * 1024
+# Every S3 part but the last must be at least 5 MiB, a multipart upload has at most `s3_max_parts` parts: larger
+# uploads get larger parts, sized at creation from `Upload-Length` (from `max_size` for a deferred length)
+s3_part_size = 8 * 1024 * 1024
+s3_max_parts = 10_000
+# `UploadPartCopy` copies at most 5 GiB per part
+s3_max_copy_size = 5 * 1024**3
+# Unfinished uploads are reclaimed `upload_expiry` after their last PATCH, at most `expiry_batch` per sweep
+upload_expiry = timedelta(days=1)
+expiry_interval = 60.0
+expiry_batch = 100
+# Hooks run on finished uploads by `hook_workers` tasks, a failed hook is retried with exponential backoff
+hook_workers = 4
+hook_max_attempts = 8
+hook_timeout = 300.0
+hook_poll_interval = 5.0
+# PATCH bodies are coalesced into `write_buffer_size` writes, aligned to the same size in the file
+write_buffer_size = 1024 * 1024
+write_threads = 8
+# Upload bandwidth in bytes/s, in total and per client, and concurrent PATCH requests per client, 0 is unlimited
+upload_rate_limit = int(os.environ.get("TUS_UPLOAD_RATE_LIMIT", 0))
+client_rate_limit = int(os.environ.get("TUS_CLIENT_RATE_LIMIT", 0))
+client_upload_limit = int(os.environ.get("TUS_CLIENT_UPLOAD_LIMIT", 0))
 
 if not os.path.exists(files_dir):
     os.mkdir(files_dir)
+if not os.path.exists(metadata_dir):
+    os.mkdir(metadata_dir)
+if not os.path.exists(locks_dir):
+    os.mkdir(locks_dir)
+
 
-from pydantic import BaseModel
+@dataclass(slots=True)
+class FileMetadata:
+    """State of an upload
 
+    A slotted dataclass rather than a pydantic model, to keep hundreds of thousands of live uploads small in memory.
+    `upload_metadata_header` is the `Upload-Metadata` header encoded once at creation, HEAD sends it as it is.
+    """
 
-class FileMetadata(BaseModel):
     uuid: str
-    upload_metadata: dict[Hashable, str]
+    upload_metadata_header: str
     upload_length: int
-    offset: int = 0
-    upload_part: int = 0
     created_at: str
     defer_length: bool
+    expires: str | None = None
+    offset: int = 0
+    upload_part: int = 0
     upload_chunk_size: int = 0
-    expires: str | None
+    # CRC32 of the bytes `[0, offset)`, updated as PATCH bodies stream in, the digest of the whole file at completion
+    checksum_crc32: int = 0
+    # Concatenation extension: "partial", "final" or None, a final upload lists the uuids of its partial uploads
+    upload_concat: str | None = None
+    partial_uploads: list[str] = field(default_factory=list)
+    # `UploadId` and part size of the multipart upload of the `s3` storage backend, 0 for `s3_part_size`
+    multipart_upload_id: str | None = None
+    part_size: int = 0
+    # Set with the offset reaching the end, cleared once the hooks are queued, finished again at startup if still set
+    completion_pending: bool = False
 
     @classmethod
     def from_request(
@@ -85,18 +172,1105 @@ class FileMetadata(BaseModel):
         created_at: str,
         defer_length: bool,
         expires: str | None = None,
+        upload_concat: str | None = None,
     ):
         return FileMetadata(
             uuid=uuid,
-            upload_metadata=upload_metadata,
+            upload_metadata_header=_encode_upload_metadata(upload_metadata),
             upload_length=upload_length,
             created_at=created_at,
             defer_length=defer_length,
             expires=expires,
+            upload_concat=upload_concat,
+        )
+
+    @property
+    def upload_metadata(self) -> dict[str, str]:
+        return _decode_upload_metadata(self.upload_metadata_header)
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FileMetadata":
+        # Records persisted before the header was cached carry the decoded `upload_metadata`
+        if "upload_metadata" in data:
+            data = dict(data)
+            data["upload_metadata_header"] = _encode_upload_metadata(data.pop("upload_metadata"))
+        return cls(**data)
+
+    @classmethod
+    def from_json(cls, text: str) -> "FileMetadata":
+        return cls.from_dict(json.loads(text))
+
+
+def _encode_upload_metadata(upload_metadata: dict[Any, str]) -> str:
+    return ",".join(f"{key} {base64.b64encode(value.encode()).decode()}" for key, value in upload_metadata.items())
+
+
+def _decode_upload_metadata(upload_metadata: str | None) -> dict[str, str]:
+    """Decode `Upload-Metadata: key base64,key base64`, a key may come without value"""
+    metadata = {}
+    if upload_metadata:
+        for kv in upload_metadata.split(","):
+            key, _, value = kv.strip().partition(" ")
+            metadata[key] = base64.b64decode(value.strip()).decode("utf-8")
+    return metadata
+
+
+class MetadataStore:
+    """Interface of the `FileMetadata` persistence backends"""
+
+    def get(self, uuid: str) -> FileMetadata | None:
+        raise NotImplementedError
+
+    def put(self, meta: FileMetadata, durable: bool = False):
+        raise NotImplementedError
+
+    def delete(self, uuid: str):
+        raise NotImplementedError
+
+    def all(self) -> list[FileMetadata]:
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class MemoryMetadataStore(MetadataStore):
+    """Process-local dict, lost on restart, only usable with one worker"""
+
+    def __init__(self):
+        self.cache: dict[str, FileMetadata] = {}
+
+    def get(self, uuid: str) -> FileMetadata | None:
+        return self.cache.get(uuid)
+
+    def put(self, meta: FileMetadata, durable: bool = False):
+        self.cache[meta.uuid] = meta
+
+    def delete(self, uuid: str):
+        self.cache.pop(uuid, None)
+
+    def all(self) -> list[FileMetadata]:
+        return list(self.cache.values())
+
+
+class JournalMetadataStore(MetadataStore):
+    """Append-only journal plus a compacted snapshot
+
+    Every `put` is appended to the journal with a single `write`, so it lives in the page cache and survives a
+    `kill -9` of the worker. `fsync` (needed only against power loss) is batched: a background thread syncs at most
+    once per `fsync_interval` seconds or `fsync_batch` records, only `durable=True` syncs inline.
+
+    When the journal grows beyond `compact_ratio` times the live records, the background thread moves it aside to
+    `metadata.journal.old`, folds the live records into the snapshot (replaced atomically with `os.replace`) and
+    removes the old journal. `put` keeps appending to a fresh journal meanwhile. Only one process may own a journal,
+    enforced by an exclusive `flock`, use `SQLiteMetadataStore` for several workers.
+
+    journal/snapshot line format: `{"op": "put", "meta": {...}}` or `{"op": "del", "uuid": "..."}`
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fsync_interval: float = metadata_fsync_interval,
+        fsync_batch: int = metadata_fsync_batch,
+        compact_ratio: int = 4,
+    ):
+        self.journal_path = os.path.join(directory, "metadata.journal")
+        self.old_journal_path = self.journal_path + ".old"
+        self.snapshot_path = os.path.join(directory, "metadata.snapshot")
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.compact_ratio = compact_ratio
+        self.cache: dict[str, FileMetadata] = {}
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.compacting = False
+        self.closed = False
+        self.wakeup = threading.Event()
+
+        # Held for the life of the process, a second worker would truncate and overwrite our records
+        self.lock_fd = os.open(os.path.join(directory, "metadata.journal.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.lock_fd)
+            raise RuntimeError(
+                f"{self.journal_path} is owned by another process, use the sqlite metadata backend with several workers"
+            ) from None
+
+        # Replay order matters: a compaction interrupted by a crash leaves the old journal next to the new one
+        self._load(self.snapshot_path)
+        self.journal_records = self._load(self.old_journal_path) + self._load(self.journal_path)
+        if os.path.exists(self.old_journal_path):
+            # Finish the interrupted compaction, the next one would replace the old journal
+            self._write_snapshot(list(self.cache.values()))
+            os.unlink(self.old_journal_path)
+        self.fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.thread = threading.Thread(target=self._background, name="tus-journal", daemon=True)
+        self.thread.start()
+
+    def _load(self, path: str) -> int:
+        """Replay `path` into the cache, a torn last line from a crash is ignored"""
+        if not os.path.exists(path):
+            return 0
+        records = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if record["op"] == "put":
+                    meta = FileMetadata.from_dict(record["meta"])
+                    self.cache[meta.uuid] = meta
+                else:
+                    self.cache.pop(record["uuid"], None)
+                records += 1
+        return records
+
+    def get(self, uuid: str) -> FileMetadata | None:
+        return self.cache.get(uuid)
+
+    def put(self, meta: FileMetadata, durable: bool = False):
+        self.cache[meta.uuid] = meta
+        self._append({"op": "put", "meta": meta.to_dict()}, durable)
+
+    def delete(self, uuid: str):
+        if self.cache.pop(uuid, None) is not None:
+            self._append({"op": "del", "uuid": uuid}, False)
+
+    def all(self) -> list[FileMetadata]:
+        return list(self.cache.values())
+
+    def _append(self, record: dict, durable: bool):
+        line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+        with self.lock:
+            os.write(self.fd, line)
+            self.journal_records += 1
+            self.unsynced += 1
+            if durable:
+                self._sync()
+            elif self.unsynced >= self.fsync_batch or (
+                not self.compacting and self.journal_records > self.compact_ratio * max(len(self.cache), 64)
+            ):
+                self.wakeup.set()
+
+    def _sync(self):
+        """`fsync` the journal, called with `self.lock` held"""
+        os.fsync(self.fd)
+        self.unsynced = 0
+
+    def _background(self):
+        """Sync and compact the journal off the request path, until `close()`"""
+        while not self.closed:
+            self.wakeup.wait(self.fsync_interval)
+            self.wakeup.clear()
+            with self.lock:
+                fd, unsynced = self.fd, self.unsynced
+                compact = self.journal_records > self.compact_ratio * max(len(self.cache), 64)
+            if unsynced:
+                os.fsync(fd)
+                with self.lock:
+                    # Only the records written before the `fsync` are known to be synced
+                    if self.fd == fd:
+                        self.unsynced -= min(unsynced, self.unsynced)
+            if compact and not self.closed:
+                self._compact()
+
+    def _compact(self):
+        """Move the journal aside, write the live records into a new snapshot, then drop the old journal
+
+        Only the swap of the journal and the copy of the cache dict take `self.lock`, the serialization and `fsync`
+        of the snapshot run without it.
+        """
+        with self.lock:
+            self.compacting = True
+            os.replace(self.journal_path, self.old_journal_path)
+            old_fd, self.fd = self.fd, os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self.journal_records = 0
+            self.unsynced = 0
+            live = list(self.cache.values())
+        try:
+            os.fsync(old_fd)
+            os.close(old_fd)
+            # The snapshot may be newer than the journals, a crash before the unlink replays them again over it,
+            # every record since the swap is in the new journal, which is replayed last
+            self._write_snapshot(live)
+            os.unlink(self.old_journal_path)
+        finally:
+            self.compacting = False
+
+    def _write_snapshot(self, live: list[FileMetadata]):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for meta in live:
+                f.write(json.dumps({"op": "put", "meta": meta.to_dict()}).encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+    def flush(self):
+        with self.lock:
+            if self.unsynced:
+                self._sync()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        os.close(self.fd)
+        os.close(self.lock_fd)
+
+
+class SQLiteMetadataStore(MetadataStore):
+    """SQLite database in WAL mode, shared by every worker process
+
+    `synchronous=NORMAL` commits without `fsync`, a commit survives a `kill -9` and the WAL is synced at checkpoints.
+    Reads always go to the database, so workers see each other's updates.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS metadata (uuid TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, uuid: str) -> FileMetadata | None:
+        row = self._conn().execute("SELECT data FROM metadata WHERE uuid = ?", (uuid,)).fetchone()
+        return FileMetadata.from_json(row[0]) if row else None
+
+    def put(self, meta: FileMetadata, durable: bool = False):
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO metadata (uuid, data) VALUES (?, ?) ON CONFLICT(uuid) DO UPDATE SET data = excluded.data",
+            (meta.uuid, meta.to_json()),
         )
+        if durable:
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def delete(self, uuid: str):
+        self._conn().execute("DELETE FROM metadata WHERE uuid = ?", (uuid,))
+
+    def all(self) -> list[FileMetadata]:
+        rows = self._conn().execute("SELECT data FROM metadata").fetchall()
+        return [FileMetadata.from_json(row[0]) for row in rows]
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+def _create_metadata_store(backend: str) -> MetadataStore:
+    if backend == "memory":
+        return MemoryMetadataStore()
+    if backend == "journal":
+        return JournalMetadataStore(metadata_dir)
+    if backend == "sqlite":
+        return SQLiteMetadataStore(os.path.join(metadata_dir, "metadata.sqlite3"))
+    raise ValueError(f"Unknown metadata backend: {backend}")
+
+
+metadata_store = _create_metadata_store(metadata_backend)
+
+
+disk_executor = ThreadPoolExecutor(max_workers=write_threads, thread_name_prefix="tus-disk")
+
+
+class ExpirySweeper:
+    """Reclaim unfinished uploads whose `expires` has passed
+
+    Uploads are kept in a min-heap keyed by expiry time, so a sweep only looks at the uploads that are due instead of
+    scanning `files_dir`. Every upload has at most one heap entry: a PATCH extending `expires` does not push again,
+    the entry is re-checked against the stored metadata when it comes due and pushed back if the upload was
+    extended or is locked by a running PATCH. Each sweep reclaims at most `batch_size` uploads, the unlinks run on
+    `disk_executor`.
+    """
+
+    def __init__(self, interval: float = expiry_interval, batch_size: int = expiry_batch):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.heap: list[tuple[float, str]] = []
+        self.scheduled: dict[str, float] = {}
+        self.task: asyncio.Task | None = None
+
+    def schedule(self, meta: FileMetadata):
+        if meta.expires is None or meta.offset == meta.upload_length:
+            return
+        expires_at = datetime.fromisoformat(meta.expires).timestamp()
+        scheduled_at = self.scheduled.get(meta.uuid)
+        if scheduled_at is None or expires_at < scheduled_at:
+            self.scheduled[meta.uuid] = expires_at
+            heapq.heappush(self.heap, (expires_at, meta.uuid))
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for meta in await loop.run_in_executor(disk_executor, metadata_store.all):
+            self.schedule(meta)
+        self.task = loop.create_task(self.work())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def work(self):
+        while True:
+            reclaimed = await self.sweep()
+            # A full batch means more uploads are due, only yield to the event loop before the next one
+            await asyncio.sleep(0 if reclaimed == self.batch_size else self.interval)
+
+    async def sweep(self) -> int:
+        now = time.time()
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            expires_at, uuid = heapq.heappop(self.heap)
+            if self.scheduled.get(uuid) != expires_at:
+                continue
+            del self.scheduled[uuid]
+            meta = _read_metadata(uuid)
+            if meta is None or meta.expires is None or meta.offset == meta.upload_length:
+                continue
+            if datetime.fromisoformat(meta.expires).timestamp() > now:
+                self.schedule(meta)
+                continue
+            due.append(uuid)
+
+        reclaimed = 0
+        for uuid in due:
+            if await _terminate_upload(uuid):
+                reclaimed += 1
+            else:
+                # Locked by a running PATCH, which extends `expires` when it finishes
+                heapq.heappush(self.heap, (now + self.interval, uuid))
+                self.scheduled[uuid] = now + self.interval
+        if reclaimed:
+            print(f"Reclaimed {reclaimed} expired uploads")
+        return reclaimed
+
+
+expiry_sweeper = ExpirySweeper()
+
+
+UploadHook = Callable[[FileMetadata], Awaitable[None]]
+upload_hooks: dict[str, UploadHook] = {}
+
+
+def upload_hook(name: str):
+    """Register an async handler run once an upload is finished, e.g.
+
+    @upload_hook("celery")
+    async def enqueue_celery_task(meta: FileMetadata):
+        process_upload.delay(meta.uuid)
+
+    Handlers run after the PATCH response, at least once: they are retried on failure and after a restart, so they
+    should be idempotent.
+    """
+
+    def decorator(func: UploadHook) -> UploadHook:
+        upload_hooks[name] = func
+        return func
+
+    return decorator
+
+
+@upload_hook("log")
+async def log_upload(meta: FileMetadata):
+    print(f"Upload finished: {meta.uuid} {meta.upload_length} bytes crc32={meta.checksum_crc32:08x}")
+
+
+class HookOutbox:
+    """Persisted queue of pending hook runs, one row per (upload, hook)
+
+    A SQLite table next to the metadata, shared by all workers. A row is claimed with a lease, so a run interrupted
+    by a crash is picked up again once its lease has expired.
+    """
+
+    def __init__(self, path: str, lease: float = hook_timeout + 60):
+        self.path = path
+        self.lease = lease
+        # Only used from the single thread of `HookDispatcher.executor`, not the thread importing this module
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, uuid TEXT NOT NULL, hook TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt REAL NOT NULL DEFAULT 0, lease_until REAL NOT NULL DEFAULT 0, error TEXT)"
+        )
+
+    def enqueue(self, uuid: str, hooks: list[str]):
+        self.conn.executemany("INSERT INTO outbox (uuid, hook) VALUES (?, ?)", [(uuid, hook) for hook in hooks])
+
+    def claim(self) -> tuple[int, str, str, int] | None:
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                "SELECT id, uuid, hook, attempts FROM outbox "
+                "WHERE status = 'pending' AND next_attempt <= ? AND lease_until <= ? ORDER BY id LIMIT 1",
+                (now, now),
+            ).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE outbox SET lease_until = ? WHERE id = ?", (now + self.lease, row[0]))
+        finally:
+            self.conn.execute("COMMIT")
+        return row
+
+    def done(self, id: int):
+        self.conn.execute("DELETE FROM outbox WHERE id = ?", (id,))
+
+    def retry(self, id: int, attempts: int, error: str):
+        status = "pending" if attempts < hook_max_attempts else "failed"
+        next_attempt = time.time() + min(2**attempts, 3600)
+        self.conn.execute(
+            "UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, lease_until = 0, error = ? WHERE id = ?",
+            (status, attempts, next_attempt, error, id),
+        )
+
+    def close(self):
+        self.conn.close()
+
+
+class HookDispatcher:
+    """Run the hooks of finished uploads with a bounded pool of `workers` tasks, off the PATCH response
+
+    The outbox queries run on a thread of their own, a `BEGIN IMMEDIATE` waiting on another worker's lock must not
+    block the event loop. `stop()` sets `stopping` and wakes the workers instead of cancelling them, a cancel can be
+    absorbed by a `wait_for` whose event is set at the same time.
+    """
+
+    def __init__(self, outbox: HookOutbox, workers: int = hook_workers):
+        self.outbox = outbox
+        self.workers = workers
+        # One thread, so the connection of the outbox is never used concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tus-hooks")
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.tasks: list[asyncio.Task] = []
+
+    async def _outbox(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    async def submit(self, uuid: str):
+        await self._outbox(self.outbox.enqueue, uuid, list(upload_hooks))
+        self.wakeup.set()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = False
+        self.tasks = [loop.create_task(self.work()) for _ in range(self.workers)]
+
+    async def stop(self, grace: float = 5.0):
+        self.stopping = True
+        self.wakeup.set()
+        if self.tasks:
+            _, running = await asyncio.wait(self.tasks, timeout=grace)
+            # Hooks still running are interrupted, their rows are claimed again once the lease expires
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.wait(running, timeout=grace)
+        self.executor.shutdown(wait=True)
+
+    async def work(self):
+        while not self.stopping:
+            # Cleared before the claim, so an upload finished while claiming wakes this worker again
+            self.wakeup.clear()
+            try:
+                row = await self._outbox(self.outbox.claim)
+                if row is not None:
+                    await self.run(*row)
+                    continue
+            except Exception as e:
+                print(f"Hook outbox failed: {e!r}")
+            if self.stopping:
+                break
+            # Also poll, for retries coming due and for uploads finished by other workers
+            wakeup = asyncio.ensure_future(self.wakeup.wait())
+            try:
+                await asyncio.wait({wakeup}, timeout=hook_poll_interval)
+            finally:
+                wakeup.cancel()
+
+    async def run(self, id: int, uuid: str, hook: str, attempts: int):
+        meta = _read_metadata(uuid)
+        if meta is None or hook not in upload_hooks:
+            await self._outbox(self.outbox.done, id)
+            return
+        try:
+            await asyncio.wait_for(upload_hooks[hook](meta), hook_timeout)
+        except Exception as e:
+            print(f"Hook {hook} failed for {uuid} (attempt {attempts + 1}): {e!r}")
+            await self._outbox(self.outbox.retry, id, attempts + 1, repr(e))
+        else:
+            await self._outbox(self.outbox.done, id)
+
+
+hook_dispatcher = HookDispatcher(HookOutbox(os.path.join(metadata_dir, "outbox.sqlite3")))
+
+
+@app.on_event("startup")
+async def startup():
+    await expiry_sweeper.start()
+    await hook_dispatcher.start()
+    await _recover_completions()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await hook_dispatcher.stop()
+    hook_dispatcher.outbox.close()
+    await expiry_sweeper.stop()
+    disk_executor.shutdown(wait=True)
+    metadata_store.close()
+
+
+class UploadMetrics:
+    """Counters of the upload hot path, exposed by `/metrics` in the Prometheus text format
+
+    Only updated from the event loop thread (disk threads return their timings to the awaiting coroutine), so plain
+    attributes are enough, no locks. Every worker process keeps its own counters.
+    """
+
+    chunk_size_buckets = [1024 * 4**i for i in range(8)]
+
+    def __init__(self):
+        self.bytes_received = 0
+        self.chunks = 0
+        self.chunk_size_counts = [0] * (len(self.chunk_size_buckets) + 1)
+        self.socket_wait_seconds = 0.0
+        self.disk_writes = 0
+        self.disk_write_bytes = 0
+        self.disk_write_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.disconnects = 0
+        self.checksum_mismatches = 0
+        self.uploads_completed = 0
+        # uuid -> [started at, bytes received] of the PATCH requests in progress
+        self.active: dict[str, list] = {}
+
+    def start(self, uuid: str):
+        self.active[uuid] = [time.monotonic(), 0]
+
+    def finish(self, uuid: str):
+        self.active.pop(uuid, None)
+
+    def observe_chunk(self, uuid: str, size: int, wait_seconds: float):
+        self.bytes_received += size
+        self.chunks += 1
+        self.chunk_size_counts[bisect.bisect_left(self.chunk_size_buckets, size)] += 1
+        self.socket_wait_seconds += wait_seconds
+        self.active[uuid][1] += size
+
+    def observe_write(self, size: int, hash_seconds: float, write_seconds: float):
+        self.disk_writes += 1
+        self.disk_write_bytes += size
+        self.hash_seconds += hash_seconds
+        self.disk_write_seconds += write_seconds
+
+    def render(self) -> str:
+        text = MetricsText()
+        text.metric("tus_received_bytes_total", "counter", "Bytes read from PATCH bodies", self.bytes_received)
+        text.metric("tus_socket_wait_seconds_total", "counter", "Time awaiting body chunks", self.socket_wait_seconds)
+        text.metric("tus_disk_writes_total", "counter", "Coalesced writes to upload files", self.disk_writes)
+        text.metric("tus_disk_write_bytes_total", "counter", "Bytes written to upload files", self.disk_write_bytes)
+        text.metric("tus_disk_write_seconds_total", "counter", "Time in pwrite", self.disk_write_seconds)
+        text.metric("tus_hash_seconds_total", "counter", "Time hashing written data", self.hash_seconds)
+        text.metric("tus_disconnects_total", "counter", "Clients disconnected mid-body", self.disconnects)
+        text.metric(
+            "tus_checksum_mismatches_total", "counter", "Bodies failing Upload-Checksum", self.checksum_mismatches
+        )
+        text.metric("tus_uploads_completed_total", "counter", "Uploads finished", self.uploads_completed)
+        text.metric("tus_active_uploads", "gauge", "PATCH requests in progress", len(self.active))
+        text.rates("tus_upload_bytes_per_second", "Receive rate of each PATCH in progress", "uuid", self.active)
+        text.histogram(
+            "tus_chunk_size_bytes",
+            "Size of the chunks read from PATCH bodies",
+            self.chunk_size_buckets,
+            self.chunk_size_counts,
+            self.bytes_received,
+        )
+        return text.render()
+
+
+upload_metrics = UploadMetrics()
+upload_shaper = UploadShaper(upload_rate_limit, client_rate_limit, client_upload_limit)
+
+
+class CRC32:
+    """`hashlib`-like wrapper of `zlib.crc32`, its state is a plain int which can be persisted and resumed"""
+
+    name = "crc32"
+
+    def __init__(self, value: int = 0):
+        self.value = value
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self) -> bytes:
+        return self.value.to_bytes(4, "big")
+
+
+def _new_hasher(algorithm: str):
+    if algorithm == "crc32":
+        return CRC32()
+    return hashlib.new(algorithm)
+
+
+def _parse_upload_checksum(upload_checksum: str | None) -> tuple[str, bytes] | None:
+    """Parse `Upload-Checksum: <algorithm> <base64 digest>` of the checksum extension"""
+    if upload_checksum is None:
+        return None
+    try:
+        algorithm, digest = upload_checksum.split(" ", 1)
+        digest = base64.b64decode(digest.strip(), validate=True)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Upload-Checksum", headers={"Tus-Resumable": tus_version})
+    if algorithm not in tus_checksum_algorithm.split(","):
+        raise HTTPException(
+            status_code=400, detail="Unsupported checksum algorithm", headers={"Tus-Resumable": tus_version}
+        )
+    return algorithm, digest
+
+
+class UploadWriter:
+    """Write a PATCH body to the storage without blocking the event loop
+
+    Chunks from `request.stream()` are coalesced in `buffer`, and every time it crosses a `buffer_size` boundary of
+    the upload the aligned part is written to the storage sink at its offset on `disk_executor`. One write is in
+    flight while the next buffer fills, `write` awaits the previous one before submitting, which stops reading the
+    socket when the storage is slower than the network.
+
+    The CRC32 of the upload is computed on the disk thread too, so hashing overlaps with reading the socket. It is
+    only stored when its write has completed, `checkpoint` is always a consistent pair of offset and CRC32.
+    """
+
+    def __init__(
+        self,
+        sink,
+        offset: int,
+        tail: bytes = b"",
+        crc32: int = 0,
+        hasher=None,
+        buffer_size: int = write_buffer_size,
+    ):
+        self.sink = sink
+        # Of the `Upload-Checksum` of the request, also updated on the disk thread
+        self.hasher = hasher
+        # Upload offset of `buffer[0]`, the buffer may start with a `tail` stored (and hashed) by an earlier PATCH
+        self.offset = offset
+        self.buffer = bytearray(tail)
+        # Bytes known to be written to the storage, and the CRC32 of the upload up to there
+        self.written = offset + len(tail)
+        self.crc32 = crc32
+        self.hashed = self.written
+        self.buffer_size = buffer_size
+        self.pending: asyncio.Future | None = None
+
+    @classmethod
+    async def open(cls, meta: FileMetadata, hasher=None) -> "UploadWriter":
+        loop = asyncio.get_running_loop()
+        sink, offset, tail = await loop.run_in_executor(disk_executor, storage.open, meta)
+        storage.remember(meta.uuid)
+        return cls(sink, offset, tail, meta.checksum_crc32, hasher, storage.block_size_of(meta))
+
+    @property
+    def checkpoint(self) -> tuple[int, int]:
+        """`(offset, crc32)` of the bytes written so far"""
+        return self.written, self.crc32
+
+    async def write(self, chunk: bytes):
+        self.buffer += chunk
+        end = (self.offset + len(self.buffer)) // self.buffer_size * self.buffer_size
+        if end > self.offset:
+            await self._submit(end - self.offset)
+
+    async def close(self):
+        try:
+            if self.buffer:
+                await self._submit(len(self.buffer), tail=True)
+            await self._wait()
+        finally:
+            await asyncio.get_running_loop().run_in_executor(disk_executor, self.sink.close)
+
+    async def _submit(self, size: int, tail: bool = False):
+        data, self.buffer = self.buffer, self.buffer[size:]
+        del data[size:]
+        await self._wait()
+        skip = max(0, self.hashed - self.offset)
+        self.hashed = max(self.hashed, self.offset + size)
+        loop = asyncio.get_running_loop()
+        # Writes are sequential, `self.crc32` already covers everything before this one
+        self.pending = loop.run_in_executor(
+            disk_executor, _hash_and_write, self.sink, data, self.offset, self.crc32, self.hasher, skip, tail
+        )
+        self.offset += size
+
+    async def _wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            crc32, hash_seconds, write_seconds = await pending
+            upload_metrics.observe_write(self.offset - self.written, hash_seconds, write_seconds)
+            self.written, self.crc32 = self.offset, crc32
+
+
+def _hash_and_write(
+    sink, data: bytearray, offset: int, crc32: int, hasher, skip: int, tail: bool
+) -> tuple[int, float, float]:
+    """Hash `data[skip:]` and write `data` at `offset`
+
+    Return the CRC32 continued from `crc32`, and the seconds spent hashing and writing, for `upload_metrics`.
+    """
+    start = time.perf_counter()
+    # `hashlib` and `zlib` release the GIL on large buffers
+    crc32 = zlib.crc32(memoryview(data)[skip:], crc32)
+    if hasher is not None:
+        hasher.update(memoryview(data)[skip:])
+    hashed = time.perf_counter()
+    if tail:
+        sink.write_tail(data, offset)
+    else:
+        sink.write(data, offset)
+    return crc32, hashed - start, time.perf_counter() - hashed
+
+
+class Storage:
+    """Interface of the backends storing upload bytes
+
+    All methods but `exists` and `path` block and are called on `disk_executor`. `open` returns a sink for
+    `UploadWriter`: `write(data, offset)` gets blocks aligned to `block_size`, `write_tail(data, offset)` the
+    unaligned rest at the end of a PATCH, and `close()`.
+    """
+
+    block_size = write_buffer_size
+
+    def __init__(self, index_size: int = storage_index_size):
+        # Uploads known to exist, so HEAD and PATCH do not `stat` the storage on every request. Uploads created by
+        # other workers are added when this worker first writes them, removed ones are caught by the metadata lookup.
+        # Bounded as an LRU, and finished uploads are forgotten, so it does not grow with every upload the worker has
+        # seen; a lookup alone does not add an upload, or every HEAD and GET of a finished one would re-add it.
+        self.index: OrderedDict[str, None] = OrderedDict()
+        self.index_size = index_size
+
+    def exists(self, uuid: str) -> bool:
+        if uuid in self.index:
+            self.index.move_to_end(uuid)
+            return True
+        return self._exists(uuid)
+
+    def remember(self, uuid: str):
+        self.index[uuid] = None
+        self.index.move_to_end(uuid)
+        if len(self.index) > self.index_size:
+            self.index.popitem(last=False)
+
+    def forget(self, uuid: str):
+        self.index.pop(uuid, None)
+
+    def path(self, uuid: str) -> str | None:
+        """Path of the upload on the local filesystem, None if it is stored elsewhere"""
+        return None
+
+    def block_size_of(self, meta: FileMetadata) -> int:
+        return self.block_size
+
+    def _exists(self, uuid: str) -> bool:
+        raise NotImplementedError
+
+    def create(self, meta: FileMetadata):
+        raise NotImplementedError
+
+    def open(self, meta: FileMetadata) -> tuple[Any, int, bytes]:
+        """Return the sink, the offset it resumes from and the bytes between that offset and `meta.offset`"""
+        raise NotImplementedError
+
+    def finish(self, meta: FileMetadata):
+        pass
+
+    def concatenate(self, meta: FileMetadata, partials: list[FileMetadata]):
+        raise NotImplementedError
+
+    def remove(self, uuid: str, meta: FileMetadata | None):
+        raise NotImplementedError
+
+
+class FileSink:
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def write(self, data: bytearray, offset: int):
+        _pwrite_all(self.fd, data, offset)
+
+    write_tail = write
+
+    def close(self):
+        os.close(self.fd)
+
 
+class LocalStorage(Storage):
+    """Files in `root`, flat or sharded into `root/ab/cd/<uuid>` to keep directories small"""
 
-metadata_cache = {}
+    def __init__(self, root: str, sharded: bool):
+        super().__init__()
+        self.root = root
+        self.sharded = sharded
+
+    def path(self, uuid: str) -> str:
+        if self.sharded:
+            return os.path.join(self.root, uuid[:2], uuid[2:4], uuid)
+        return os.path.join(self.root, uuid)
+
+    def _exists(self, uuid: str) -> bool:
+        return os.path.exists(self.path(uuid))
+
+    def create(self, meta: FileMetadata):
+        path = self.path(meta.uuid)
+        if self.sharded:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        _create_upload_file(path, None if meta.defer_length else meta.upload_length)
+        self.remember(meta.uuid)
+
+    def open(self, meta: FileMetadata) -> tuple[FileSink, int, bytes]:
+        return FileSink(_open_for_write(self.path(meta.uuid), meta.offset, meta.defer_length)), meta.offset, b""
+
+    def concatenate(self, meta: FileMetadata, partials: list[FileMetadata]):
+        path = self.path(meta.uuid)
+        if self.sharded:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        _concatenate_files(path, [self.path(partial.uuid) for partial in partials])
+        self.remember(meta.uuid)
+
+    def remove(self, uuid: str, meta: FileMetadata | None):
+        self.forget(uuid)
+        try:
+            os.remove(self.path(uuid))
+        except FileNotFoundError:
+            pass
+
+
+def _open_for_write(path: str, offset: int, truncate: bool) -> int:
+    fd = os.open(path, os.O_WRONLY)
+    # Bytes written after the last persisted offset (e.g. before a crash) are dropped, the client resends them.
+    # A file of known length is preallocated, stale bytes are simply overwritten by the positional writes.
+    if truncate:
+        os.ftruncate(fd, offset)
+    return fd
+
+
+def _create_upload_file(path: str, upload_length: int | None):
+    """Create the file of an upload, preallocated to `upload_length` when it is known
+
+    `posix_fallocate` reserves the extents up front, so the filesystem can lay out the file contiguously instead
+    of growing it by many small appends, and running out of space fails at creation instead of mid-upload.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if upload_length:
+            try:
+                os.posix_fallocate(fd, 0, upload_length)
+            except OSError as e:
+                # Not supported by the filesystem, the file just grows as it is written
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+    except OSError:
+        os.close(fd)
+        os.remove(path)
+        raise
+    os.close(fd)
+
+
+def _pwrite_all(fd: int, data: bytearray, offset: int):
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+
+class S3Sink:
+    def __init__(self, storage: "S3Storage", meta: FileMetadata):
+        self.storage = storage
+        self.key = meta.uuid
+        self.upload_id = meta.multipart_upload_id
+        self.upload_length = None if meta.defer_length else meta.upload_length
+        self.part_size = storage.block_size_of(meta)
+
+    def write(self, data: bytearray, offset: int):
+        self.storage.client.upload_part(
+            Bucket=self.storage.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=offset // self.part_size + 1,
+            Body=bytes(data),
+        )
+
+    def write_tail(self, data: bytearray, offset: int):
+        end = offset + len(data)
+        # Only the last part may be smaller than `part_size`, a shorter tail is kept in its own object until the
+        # next PATCH completes the part. It is named by its end offset, so a rolled back PATCH leaves the previous one.
+        if end == self.upload_length:
+            self.write(data, offset)
+        else:
+            self.storage.client.put_object(Bucket=self.storage.bucket, Key=f"{self.key}.part.{end}", Body=bytes(data))
+
+    def close(self):
+        pass
+
+
+class S3Storage(Storage):
+    """Multipart uploads on an S3-compatible object store
+
+    Every `part_size` of a PATCH body is sent as one part while the body streams in, the upload is completed by
+    `CompleteMultipartUpload` when the last byte arrives. Final uploads of the concatenation extension are built
+    server-side with `UploadPartCopy`, in parts of at most `s3_max_copy_size`, so every partial upload but the last
+    must be at least 5 MiB.
+    """
+
+    block_size = s3_part_size
+
+    def __init__(self, bucket: str, endpoint_url: str | None = None):
+        super().__init__()
+        import boto3
+        import botocore.exceptions
+
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        try:
+            self.client.head_bucket(Bucket=bucket)
+        except botocore.exceptions.ClientError:
+            self.client.create_bucket(Bucket=bucket)
+
+    def _exists(self, uuid: str) -> bool:
+        # An unfinished multipart upload is not an object yet, its metadata is the record of it
+        return _read_metadata(uuid) is not None
+
+    def block_size_of(self, meta: FileMetadata) -> int:
+        return meta.part_size or self.block_size
+
+    def create(self, meta: FileMetadata):
+        length = max_size if meta.defer_length else meta.upload_length
+        # Rounded up to MiB, so that `s3_max_parts` parts hold the whole upload
+        min_part_size = -(-length // (s3_max_parts * 1024 * 1024)) * 1024 * 1024
+        meta.part_size = max(self.block_size, min_part_size)
+        meta.multipart_upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=meta.uuid)["UploadId"]
+        self.remember(meta.uuid)
+
+    def open(self, meta: FileMetadata) -> tuple[S3Sink, int, bytes]:
+        part_size = self.block_size_of(meta)
+        offset = meta.offset // part_size * part_size
+        tail = b""
+        if meta.offset > offset:
+            tail = self.client.get_object(Bucket=self.bucket, Key=f"{meta.uuid}.part.{meta.offset}")["Body"].read()
+        return S3Sink(self, meta), offset, tail
+
+    def finish(self, meta: FileMetadata):
+        parts = []
+        paginator = self.client.get_paginator("list_parts")
+        try:
+            for page in paginator.paginate(Bucket=self.bucket, Key=meta.uuid, UploadId=meta.multipart_upload_id):
+                parts += [{"ETag": p["ETag"], "PartNumber": p["PartNumber"]} for p in page.get("Parts", [])]
+            # Parts past the end may be left by a PATCH rolled back after a checksum mismatch
+            last_part = (meta.upload_length - 1) // self.block_size_of(meta) + 1 if meta.upload_length else 1
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=meta.uuid,
+                UploadId=meta.multipart_upload_id,
+                MultipartUpload={"Parts": [p for p in parts if p["PartNumber"] <= last_part]},
+            )
+        except self.client.exceptions.NoSuchUpload:
+            # Completed before a crash, finished again by `_recover_completions`
+            pass
+        self._remove_tails(meta.uuid)
+
+    def concatenate(self, meta: FileMetadata, partials: list[FileMetadata]):
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=meta.uuid)["UploadId"]
+        parts = []
+        for partial in partials:
+            copy_ranges = [{}]
+            if partial.upload_length > s3_max_copy_size:
+                # Split in equal ranges, so none but the last part of the final upload is under 5 MiB
+                count = -(-partial.upload_length // s3_max_copy_size)
+                size = -(-partial.upload_length // count)
+                copy_ranges = [
+                    {"CopySourceRange": f"bytes={start}-{min(start + size, partial.upload_length) - 1}"}
+                    for start in range(0, partial.upload_length, size)
+                ]
+            for copy_range in copy_ranges:
+                number = len(parts) + 1
+                result = self.client.upload_part_copy(
+                    Bucket=self.bucket,
+                    Key=meta.uuid,
+                    UploadId=upload_id,
+                    PartNumber=number,
+                    CopySource={"Bucket": self.bucket, "Key": partial.uuid},
+                    **copy_range,
+                )
+                parts.append({"ETag": result["CopyPartResult"]["ETag"], "PartNumber": number})
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=meta.uuid, UploadId=upload_id, MultipartUpload={"Parts": parts}
+        )
+        self.remember(meta.uuid)
+
+    def download_url(self, uuid: str, expires_in: int = 3600) -> str:
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": uuid}, ExpiresIn=expires_in
+        )
+
+    def remove(self, uuid: str, meta: FileMetadata | None):
+        self.forget(uuid)
+        if meta is not None and meta.multipart_upload_id and meta.offset != meta.upload_length:
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=uuid, UploadId=meta.multipart_upload_id)
+            except self.client.exceptions.NoSuchUpload:
+                pass
+        self.client.delete_object(Bucket=self.bucket, Key=uuid)
+        self._remove_tails(uuid)
+
+    def _remove_tails(self, uuid: str):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{uuid}.part."):
+            for item in page.get("Contents", []):
+                self.client.delete_object(Bucket=self.bucket, Key=item["Key"])
+
+
+def _create_storage(backend: str) -> Storage:
+    if backend == "local":
+        return LocalStorage(files_dir, sharded=False)
+    if backend == "sharded":
+        return LocalStorage(files_dir, sharded=True)
+    if backend == "s3":
+        return S3Storage(s3_bucket, s3_endpoint_url)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+storage = _create_storage(storage_backend)
 
 
 @app.get("/")
@@ -118,26 +1292,32 @@ async def create_upload_resource(
     upload_defer_length: int = Header(None),
     content_length: int = Header(None),
     content_type: str = Header(None),
+    upload_concat: str = Header(None),
 ):
+    # Concatenation, `Upload-Concat: final;<url> <url>` assembles finished partial uploads and has no Upload-Length
+    partials = _parse_upload_concat(upload_concat)
+    if partials:
+        upload_length = sum(partial.upload_length for partial in partials)
+
     if upload_defer_length is not None and upload_defer_length != 1:
         raise HTTPException(status_code=400, detail="Invalid Upload-Defer-Length")
 
     if upload_length is None and upload_defer_length is None:
         raise HTTPException(status_code=400, detail="Invalid Upload-Defer-Length")
 
+    if upload_length is not None and upload_length > max_size:
+        raise HTTPException(status_code=413, detail="Upload-Length exceeds Tus-Max-Size")
+
     if upload_length is not None and upload_length > 0:
         defer_length = False
     else:
         defer_length = True
 
     # Create a new upload and store the file and metadata in the mapping
-    metadata = {}
-    if upload_metadata is not None and upload_metadata != "":
-        # Decode the base64-encoded string
-        for kv in upload_metadata.split(","):
-            key, value = kv.rsplit(" ", 1)
-            decoded_value = base64.b64decode(value.strip()).decode("utf-8")
-            metadata[key.strip()] = decoded_value
+    try:
+        metadata = _decode_upload_metadata(upload_metadata)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Upload-Metadata")
 
     uuid = str(uuid4().hex)
 
@@ -147,29 +1327,51 @@ async def create_upload_resource(
         upload_length,
         str(datetime.now()),
         defer_length,
-        None,
+        None if partials else _new_expiry(),
+        "final" if partials else upload_concat,
     )
 
-    _write_metadata(meta)
+    if partials:
+        await _concatenate_uploads(meta, partials)
+        await _upload_completed(meta)
+        response.headers["Location"] = f"{location}/{uuid}"
+        response.headers["Tus-Resumable"] = tus_version
+        response.status_code = 201
+        return
+
+    # Create the file (preallocated if its length is known) or the multipart upload, then its metadata
+    try:
+        await asyncio.get_running_loop().run_in_executor(disk_executor, storage.create, meta)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise HTTPException(status_code=507, detail="Insufficient storage for Upload-Length")
+        raise
 
-    # Create the empty file
-    open(os.path.join(files_dir, f"{uuid}"), "a").close()
+    _write_metadata(meta, durable=True)
 
     # Creation With Upload, similar with `PATCH` request
     if content_length and content_length and upload_length and not defer_length:
         assert content_type == "application/offset+octet-stream"
 
-        meta = await _save_request_stream(request, uuid)
+        checksum = _parse_upload_checksum(request.headers.get("Upload-Checksum"))
+        try:
+            with upload_shaper.slot(_client_id(request)):
+                meta = await _save_request_stream(request, uuid, checksum=checksum)
+        except TooManyUploads:
+            # The upload is created, the client sends the body in a PATCH from `Upload-Offset: 0`
+            meta = _read_metadata(uuid)
 
         if not meta:
             response.status_code = 412
             response.headers["Tus-Resumable"] = tus_version
             return
 
-        date_expiry = datetime.now() + timedelta(days=1)
-        meta.expires = str(date_expiry.isoformat())
+        meta.expires = _new_expiry()
         _write_metadata(meta)
 
+        if meta.completion_pending:
+            await _finish_upload(meta)
+
         response.headers["Location"] = f"{location}/{uuid}"
         response.headers["Tus-Resumable"] = tus_version
         response.headers["Upload-Offset"] = str(meta.offset)
@@ -182,6 +1384,7 @@ async def create_upload_resource(
     else:
         response.headers["Location"] = f"{location}/{uuid}"
         response.headers["Tus-Resumable"] = tus_version
+        response.headers["Upload-Expires"] = str(meta.expires)
 
         response.status_code = 201
         return
@@ -201,12 +1404,14 @@ async def read_file_meta(request: Request, response: Response, uuid: str):
     if meta.defer_length:
         response.headers["Upload-Defer-Length"] = str(1)
 
-    # Encode metadata
-    if meta.upload_metadata:
-        metadata_base64 = ""
-        for key, value in meta.upload_metadata.items():
-            metadata_base64 += f"{key} {base64.b64encode(bytes(value, 'utf-8'))},"
-        response.headers["Upload-Metadata"] = metadata_base64.strip(",")
+    if meta.upload_concat == "final":
+        response.headers["Upload-Concat"] = "final;" + " ".join(f"{location}/{p}" for p in meta.partial_uploads)
+    elif meta.upload_concat == "partial":
+        response.headers["Upload-Concat"] = "partial"
+
+    # Encoded once at creation
+    if meta.upload_metadata_header:
+        response.headers["Upload-Metadata"] = meta.upload_metadata_header
 
     response.status_code = 200
     return ""
@@ -214,6 +1419,47 @@ async def read_file_meta(request: Request, response: Response, uuid: str):
 
 @app.patch("/files/{uuid}")
 async def upload_file(request: Request, response: Response, uuid: str):
+    if not _file_exists(uuid):
+        response.status_code = 404
+        response.headers["Tus-Resumable"] = tus_version
+        return
+
+    # A finished upload is never written again, it is answered without its lease, which would recreate the lock file
+    meta = _read_metadata(uuid)
+    if meta and meta.offset == meta.upload_length and not meta.defer_length:
+        return _patch_finished_upload(request, response, meta)
+
+    try:
+        with upload_shaper.slot(_client_id(request)):
+            # Only one PATCH may write an upload at a time, across all worker processes
+            with _upload_lock(uuid) as locked:
+                if not locked:
+                    response.status_code = 423
+                    response.headers["Tus-Resumable"] = tus_version
+                    return
+                return await _upload_file(request, response, uuid)
+    except TooManyUploads:
+        response.status_code = 429
+        response.headers["Tus-Resumable"] = tus_version
+        response.headers["Retry-After"] = "1"
+        return
+
+
+def _patch_finished_upload(request: Request, response: Response, meta: FileMetadata):
+    response.headers["Tus-Resumable"] = tus_version
+    if meta.upload_concat == "final":
+        response.status_code = 403
+    elif int(request.headers["Upload-Offset"]) != meta.offset:
+        response.status_code = 409
+    elif int(request.headers["Content-Length"]):
+        response.status_code = 413
+    else:
+        response.headers["Upload-Offset"] = str(meta.offset)
+        response.status_code = 204
+    return ""
+
+
+async def _upload_file(request: Request, response: Response, uuid: str):
     tus_resumable = request.headers["Tus-Resumable"]
     content_length = int(request.headers["Content-Length"])
     content_type = request.headers["Content-Type"]
@@ -226,10 +1472,18 @@ async def upload_file(request: Request, response: Response, uuid: str):
 
     # PATCH request against a non-existent resource
     if not meta or not _file_exists(uuid):
+        # The upload was terminated after our lookup, the lease just created its lock file again
+        _remove_lock_file(uuid)
         response.status_code = 404
         response.headers["Tus-Resumable"] = tus_version
         return
 
+    # A final upload is complete on creation and must not be patched
+    if meta.upload_concat == "final":
+        response.status_code = 403
+        response.headers["Tus-Resumable"] = tus_version
+        return
+
     if meta.defer_length:
         if request.headers["Upload-Length"]:
             response.status_code = 412
@@ -247,8 +1501,15 @@ async def upload_file(request: Request, response: Response, uuid: str):
         response.headers["Tus-Resumable"] = tus_version
         return
 
+    # A deferred length may not grow past `Tus-Max-Size`, the storage is sized for at most that much
+    if meta.defer_length and upload_offset + content_length > max_size:
+        response.status_code = 413
+        response.headers["Tus-Resumable"] = tus_version
+        return
+
     # Saving
-    meta = await _save_request_stream(request, uuid)
+    checksum = _parse_upload_checksum(request.headers.get("Upload-Checksum"))
+    meta = await _save_request_stream(request, uuid, checksum=checksum)
 
     # TODO: move above to `save_request_stream`
     if not meta:
@@ -262,14 +1523,12 @@ async def upload_file(request: Request, response: Response, uuid: str):
         response.headers["Tus-Resumable"] = tus_version
         return
 
-    date_expiry = datetime.now() + timedelta(days=1)
-    meta.expires = str(date_expiry.isoformat())
+    meta.expires = _new_expiry()
     _write_metadata(meta)
 
     # Upload file complete
-    if meta.upload_length == meta.offset:
-        # TODO: callbacks should be here
-        pass
+    if meta.completion_pending:
+        await _finish_upload(meta)
 
     response.headers["Location"] = f"{location}/{uuid}"
     response.headers["Tus-Resumable"] = tus_version
@@ -295,44 +1554,362 @@ async def read_tus_config(request: Request, response: Response):
     return ""
 
 
-@app.delete("/files/{uuid}")
-async def delete_file(request: Request):
-    pass
+"""
+curl -v -H "Range: bytes=0-99" http://127.0.0.1:8000/files/<uuid>
+"""
 
 
-async def _save_request_stream(request: Request, uuid: str, post_request: bool = False) -> FileMetadata | None:
+@app.get("/files/{uuid}")
+async def download_file(request: Request, uuid: str):
     meta = _read_metadata(uuid)
-    if not meta or not os.path.exists(os.path.join(files_dir, uuid)):
+    if meta is None or not _file_exists(uuid):
+        raise HTTPException(status_code=404)
+    if meta.offset != meta.upload_length:
+        raise HTTPException(status_code=409, detail="Upload not finished")
+
+    # Uploads are immutable once finished, their CRC32 and length identify the content
+    etag = f'"{meta.checksum_crc32:08x}-{meta.upload_length:x}"'
+    metadata = meta.upload_metadata
+    # `filetype` comes from the client: the file is always an attachment and never sniffed, so an upload declared as
+    # `text/html` cannot run in the browser on this origin
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "Content-Type": metadata.get("filetype", "application/octet-stream"),
+        "Content-Disposition": "attachment",
+        "X-Content-Type-Options": "nosniff",
+    }
+    if "filename" in metadata:
+        headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(metadata['filename'])}"
+
+    if _etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    path = _file_path(uuid)
+    if path is None:
+        # Not on the local disk, let the object store serve the bytes
+        return RedirectResponse(storage.download_url(uuid), status_code=307)
+
+    # Handles `Range`, with one or several ranges, and `If-Range` against the ETag above
+    response = FileResponse(path, headers=headers, media_type=headers["Content-Type"])
+    response.chunk_size = download_chunk_size
+    return response
+
+
+def _etag_matches(header: str | None, etag: str) -> bool:
+    """Whether an `If-None-Match` list of entity tags matches `etag`, weakly, as RFC 7232 compares them for GET"""
+    if header is None:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    return PlainTextResponse(
+        upload_metrics.render() + upload_shaper.render("tus"), media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.delete("/files/{uuid}", status_code=204)
+async def delete_file(request: Request, response: Response, uuid: str):
+    response.headers["Tus-Resumable"] = tus_version
+    if _read_metadata(uuid) is None:
+        raise HTTPException(status_code=404, headers={"Tus-Resumable": tus_version})
+
+    # Termination of an upload with a running PATCH is refused, like a concurrent PATCH
+    if not await _terminate_upload(uuid):
+        raise HTTPException(status_code=423, headers={"Tus-Resumable": tus_version})
+
+    return ""
+
+
+async def _save_request_stream(
+    request: Request, uuid: str, post_request: bool = False, checksum: tuple[str, bytes] | None = None
+) -> FileMetadata | None:
+    meta = _read_metadata(uuid)
+    if not meta or not storage.exists(uuid):
         return None
 
-    f = open(f"{files_dir}/{uuid}", "ab")
+    start_offset, start_crc32 = meta.offset, meta.checksum_crc32
+    request_hasher = _new_hasher(checksum[0]) if checksum else None
+
+    writer = await UploadWriter.open(meta, request_hasher)
+    checkpoint = meta.offset
+    client = _client_id(request)
+    upload_metrics.start(uuid)
+    received = time.perf_counter()
     try:
         async for chunk in request.stream():
             chunk_size = len(chunk)
-            f.write(chunk)
-            meta.offset += chunk_size
+            if chunk_size:
+                upload_metrics.observe_chunk(uuid, chunk_size, time.perf_counter() - received)
+                await upload_shaper.throttle(client, chunk_size)
+            await writer.write(chunk)
+            meta.offset, crc32 = writer.checkpoint
             meta.upload_chunk_size = chunk_size
             meta.upload_part += 1
+            # Coalesce the offset updates, only bytes already written to the file are counted.
+            # A body with `Upload-Checksum` is committed all at once, after it is verified.
+            if not checksum and meta.offset - checkpoint >= metadata_checkpoint_bytes:
+                meta.checksum_crc32 = crc32
+                _write_metadata(meta)
+                checkpoint = meta.offset
+            received = time.perf_counter()
     except ClientDisconnect as e:
+        upload_metrics.disconnects += 1
         print(f"Client disconnected: {e}")
     finally:
+        upload_metrics.finish(uuid)
+        await writer.close()
+        meta.offset, meta.checksum_crc32 = writer.checkpoint
+        # Only the request moving the offset to the end finishes the upload, not a later empty PATCH at the end
+        meta.completion_pending = start_offset < meta.offset == meta.upload_length
+        if not checksum:
+            _write_metadata(meta)
+
+    if checksum:
+        if request_hasher.digest() != checksum[1]:
+            # Discard the whole body, the next PATCH writes again from `start_offset`
+            upload_metrics.checksum_mismatches += 1
+            meta.offset, meta.checksum_crc32 = start_offset, start_crc32
+            meta.completion_pending = False
+            _write_metadata(meta)
+            raise HTTPException(status_code=460, detail="Checksum Mismatch", headers={"Tus-Resumable": tus_version})
         _write_metadata(meta)
-        f.close()
 
     return meta
 
 
+def _client_id(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+
+def _parse_upload_concat(upload_concat: str | None) -> list[FileMetadata]:
+    """Validate `Upload-Concat`, return the finished partial uploads of a final upload, in order"""
+    if upload_concat is None or upload_concat == "partial":
+        return []
+    if not upload_concat.startswith("final;"):
+        raise HTTPException(status_code=400, detail="Invalid Upload-Concat")
+
+    partials = []
+    for url in upload_concat[len("final;") :].split():
+        meta = _read_metadata(url.rstrip("/").rsplit("/", 1)[-1])
+        if meta is None or meta.upload_concat != "partial" or meta.offset != meta.upload_length:
+            raise HTTPException(status_code=400, detail=f"Not a finished partial upload: {url}")
+        partials.append(meta)
+    if not partials:
+        raise HTTPException(status_code=400, detail="Invalid Upload-Concat")
+    return partials
+
+
+async def _concatenate_uploads(meta: FileMetadata, partials: list[FileMetadata]):
+    """Create the file of a final upload from its partial uploads and persist its metadata"""
+    await asyncio.get_running_loop().run_in_executor(disk_executor, storage.concatenate, meta, partials)
+
+    crc = 0
+    for partial in partials:
+        crc = crc32_combine(crc, partial.checksum_crc32, partial.upload_length)
+    meta.offset = meta.upload_length
+    meta.checksum_crc32 = crc
+    meta.partial_uploads = [partial.uuid for partial in partials]
+    meta.completion_pending = True
+    _write_metadata(meta, durable=True)
+
+
+def _concatenate_files(dst_path: str, src_paths: list[str]):
+    """Copy `src_paths` one after another into `dst_path` inside the kernel
+
+    `os.copy_file_range` never moves the bytes through user space, and on copy-on-write filesystems (btrfs, xfs with
+    reflink, ...) it shares the extents instead of copying them. Falls back to `os.sendfile` when the filesystem
+    does not support it.
+    """
+    with open(dst_path, "wb") as dst:
+        offset = 0
+        for src_path in src_paths:
+            with open(src_path, "rb") as src:
+                size = os.fstat(src.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    n = _copy_range(src.fileno(), dst.fileno(), copied, offset, size - copied)
+                    if n == 0:
+                        raise OSError(errno.EIO, f"Unexpected end of {src_path}")
+                    copied += n
+                    offset += n
+
+
+def _copy_range(src_fd: int, dst_fd: int, src_offset: int, dst_offset: int, count: int) -> int:
+    try:
+        return os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+    except (AttributeError, OSError) as e:
+        if isinstance(e, OSError) and e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, src_offset, count)
+
+
+def _gf2_matrix_times(mat: list[int], vec: int) -> int:
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(mat: list[int]) -> list[int]:
+    return [_gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+
+def crc32_combine(crc1: int, crc2: int, len2: int) -> int:
+    """CRC32 of `A + B` from `crc32(A)`, `crc32(B)` and `len(B)`, port of zlib's `crc32_combine`"""
+    if len2 <= 0:
+        return crc1
+
+    # Operator for one zero bit, then for two and four zero bits
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+
+    # Apply `len2` zero bytes to `crc1`
+    while True:
+        even = _gf2_matrix_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_matrix_square(even)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+
+    return crc1 ^ crc2
+
+
+async def _finish_upload(meta: FileMetadata):
+    await asyncio.get_running_loop().run_in_executor(disk_executor, storage.finish, meta)
+    await _upload_completed(meta)
+
+
+async def _upload_completed(meta: FileMetadata):
+    """Queue the hooks of a finished upload, then clear `completion_pending`, which was persisted with the offset"""
+    uuid = meta.uuid
+    upload_metrics.uploads_completed += 1
+    # A finished upload is only read from now on, neither its lease nor its index entry is needed. Removing the lock
+    # file while a PATCH still holds it is safe, `_upload_lock` refuses a lease on an unlinked file
+    storage.forget(uuid)
+    _remove_lock_file(uuid)
+    await hook_dispatcher.submit(uuid)
+    meta.completion_pending = False
+    _write_metadata(meta)
+
+
+async def _recover_completions():
+    """Finish the uploads a crash interrupted between reaching their end and queueing their hooks"""
+    for meta in await asyncio.get_running_loop().run_in_executor(disk_executor, metadata_store.all):
+        if not meta.completion_pending:
+            continue
+        # A final upload has no multipart upload to complete, it is written whole by `_concatenate_uploads`
+        if meta.upload_concat == "final":
+            await _upload_completed(meta)
+        else:
+            await _finish_upload(meta)
+
+
+async def _terminate_upload(uuid: str) -> bool:
+    """Remove the file and metadata of an upload, return False if a PATCH holds its lease
+
+    A finished upload is removed without the lease, no PATCH writes it anymore.
+    """
+    meta = _read_metadata(uuid)
+    if meta and meta.offset == meta.upload_length and not meta.defer_length:
+        await _remove_upload(uuid)
+        return True
+    with _upload_lock(uuid) as locked:
+        if not locked:
+            return False
+        await _remove_upload(uuid)
+        # Only once the metadata is gone, a PATCH that takes a new lock file then finds no upload
+        _remove_lock_file(uuid)
+    return True
+
+
+async def _remove_upload(uuid: str):
+    await asyncio.get_running_loop().run_in_executor(disk_executor, _remove_upload_files, uuid)
+    metadata_store.delete(uuid)
+
+
+def _remove_upload_files(uuid: str):
+    storage.remove(uuid, _read_metadata(uuid))
+
+
+def _lock_path(uuid: str) -> str:
+    # Sharded like the uploads, `locks_dir/ab/cd/<uuid>`
+    return os.path.join(locks_dir, uuid[:2], uuid[2:4], uuid)
+
+
+def _remove_lock_file(uuid: str):
+    try:
+        os.remove(_lock_path(uuid))
+    except FileNotFoundError:
+        pass
+
+
+def _new_expiry() -> str:
+    return str((datetime.now() + upload_expiry).isoformat())
+
+
 def _read_metadata(uuid) -> FileMetadata | None:
-    return metadata_cache.get(uuid)
+    return metadata_store.get(uuid)
 
 
-def _write_metadata(meta: FileMetadata):
-    metadata_cache[meta.uuid] = meta
+def _write_metadata(meta: FileMetadata, durable: bool = False):
+    metadata_store.put(meta, durable)
+    expiry_sweeper.schedule(meta)
+
+
+@contextmanager
+def _upload_lock(uuid: str):
+    """Try to take the exclusive lease of an upload, yield whether it was acquired
+
+    The lease is a non-blocking `flock` on `_lock_path(uuid)`. It is held by the open file description, so it
+    conflicts between workers as well as between requests in the same worker, and the kernel releases it when a
+    worker dies. The lock file is removed when the upload finishes or is terminated, a lease taken on a file that
+    was unlinked meanwhile is refused, since a request opening the path now gets a new file and a lease of its own.
+    """
+    path = _lock_path(uuid)
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            current = os.stat(path).st_ino
+        except FileNotFoundError:
+            current = None
+        yield current == os.fstat(fd).st_ino
+    finally:
+        os.close(fd)
 
 
 def _file_exists(uuid: str) -> bool:
-    return os.path.exists(os.path.join(files_dir, uuid))
+    return storage.exists(uuid)
 
 
-def _file_path(uuid: str) -> str:
-    return os.path.join(files_dir, uuid)
+def _file_path(uuid: str) -> str | None:
+    return storage.path(uuid)
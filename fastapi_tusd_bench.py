@@ -0,0 +1,123 @@
+"""
+Usage:
+python fastapi_tusd_bench.py --workers 1 2 4 --clients 32 --size 64
+
+Description:
+Load test of the tus server in `fastapi_tusd.py`.
+
+For every worker count it starts `uvicorn fastapi_tusd:app --workers N`, lets `--clients` concurrent clients each upload
+`--size` MiB in `--chunk` MiB PATCH requests, and reports the aggregate throughput. Aggregate MB/s should grow about
+linearly with the worker count until the disk or the client side saturates.
+
+It also checks the per-upload lease: two PATCH requests racing on the same upload must never both succeed, the loser
+gets `423 Locked` (or `409 Conflict` when it arrives after the winner has moved the offset).
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+tus_version = "1.0.0"
+
+
+async def create_upload(client: httpx.AsyncClient, length: int) -> str:
+    r = await client.post("/files", headers={"Tus-Resumable": tus_version, "Upload-Length": str(length)})
+    assert r.status_code == 201, r.status_code
+    return r.headers["Location"].rsplit("/", 1)[1]
+
+
+async def patch(client: httpx.AsyncClient, uuid: str, offset: int, body: bytes) -> httpx.Response:
+    return await client.patch(
+        f"/files/{uuid}",
+        content=body,
+        headers={
+            "Tus-Resumable": tus_version,
+            "Content-Type": "application/offset+octet-stream",
+            "Upload-Offset": str(offset),
+        },
+    )
+
+
+async def upload_one(client: httpx.AsyncClient, size: int, chunk: bytes):
+    uuid = await create_upload(client, size)
+    offset = 0
+    while offset < size:
+        body = chunk[: size - offset]
+        r = await patch(client, uuid, offset, body)
+        assert r.status_code == 204, r.status_code
+        offset = int(r.headers["Upload-Offset"])
+
+
+async def run_clients(base_url: str, clients: int, size: int, chunk_size: int) -> float:
+    chunk = os.urandom(chunk_size)
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(base_url=base_url, timeout=600, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(upload_one(client, size, chunk) for _ in range(clients)))
+        return time.perf_counter() - start
+
+
+async def check_lease(base_url: str):
+    body = os.urandom(16 * 1024 * 1024)
+    async with httpx.AsyncClient(base_url=base_url, timeout=600) as client:
+        uuid = await create_upload(client, len(body))
+        results = await asyncio.gather(*(patch(client, uuid, 0, body) for _ in range(4)))
+        codes = sorted(r.status_code for r in results)
+        assert codes.count(204) == 1 and set(codes) <= {204, 409, 423}, codes
+        print(f"lease check: {codes}")
+
+
+def wait_ready(base_url: str, proc: subprocess.Popen):
+    for _ in range(100):
+        if proc.poll() is not None:
+            raise RuntimeError("uvicorn exited")
+        try:
+            httpx.options(f"{base_url}/files")
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError("uvicorn did not start")
+
+
+def bench(workers: int, args) -> float:
+    base_url = f"http://127.0.0.1:{args.port}"
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "fastapi_tusd:app", "--port", str(args.port), "--workers", str(workers)],
+        cwd=os.path.dirname(os.path.realpath(__file__)),
+        env={**os.environ, "TUS_METADATA_BACKEND": "sqlite"},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_ready(base_url, proc)
+        asyncio.run(check_lease(base_url))
+        size = args.size * 1024 * 1024
+        elapsed = asyncio.run(run_clients(base_url, args.clients, size, args.chunk * 1024 * 1024))
+        return args.clients * size / elapsed / 1e6
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--size", type=int, default=64, help="MiB per upload")
+    parser.add_argument("--chunk", type=int, default=8, help="MiB per PATCH request")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    baseline = None
+    for workers in args.workers:
+        mbps = bench(workers, args)
+        baseline = baseline or mbps / workers
+        print(f"workers={workers:<3} {mbps:10.1f} MB/s  scaling={mbps / baseline:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
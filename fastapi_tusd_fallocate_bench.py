@@ -0,0 +1,102 @@
+"""
+Usage:
+python fastapi_tusd_fallocate_bench.py --dir /tmp/files --sizes 1 10 100 --concurrency 4
+
+Description:
+Compare the two ways `fastapi_tusd.py` can lay out an upload on disk:
+- `append`: create an empty file and grow it by appending every chunk
+- `fallocate`: `posix_fallocate` the full `Upload-Length` at creation, then `os.pwrite` every chunk at its offset
+
+`--concurrency` uploads of each size are written at the same time, interleaved like concurrent PATCH requests, which is
+what fragments appended files. For every mode it reports the throughput (including the final `fsync`) and the average
+number of extents per file, read with the `FS_IOC_FIEMAP` ioctl (Linux only, fewer is better).
+
+Sizes are in GiB and the directory needs `concurrency * size` free space, run it on the filesystem of `files_dir`.
+"""
+import argparse
+import os
+import struct
+import threading
+import time
+import fcntl
+
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap: fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+FIEMAP_FORMAT = "=QQIIII"
+FIEMAP_FLAG_SYNC = 0x1
+
+
+def count_extents(path: str) -> int:
+    """Number of extents of `path`, with `fm_extent_count = 0` the kernel only counts them"""
+    with open(path, "rb") as f:
+        request = struct.pack(FIEMAP_FORMAT, 0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC, 0, 0, 0)
+        result = fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    return struct.unpack(FIEMAP_FORMAT, result)[3]
+
+
+def write_append(path: str, size: int, chunk: bytes, barrier: threading.Barrier):
+    with open(path, "ab") as f:
+        barrier.wait()
+        written = 0
+        while written < size:
+            n = f.write(chunk[: size - written])
+            written += n
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_fallocate(path: str, size: int, chunk: bytes, barrier: threading.Barrier):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.posix_fallocate(fd, 0, size)
+        barrier.wait()
+        offset = 0
+        while offset < size:
+            offset += os.pwrite(fd, chunk[: size - offset], offset)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def bench(mode: str, directory: str, size: int, concurrency: int, chunk: bytes) -> tuple[float, float]:
+    write = write_append if mode == "append" else write_fallocate
+    paths = [os.path.join(directory, f"bench-{mode}-{i}") for i in range(concurrency)]
+    barrier = threading.Barrier(concurrency + 1)
+    threads = [threading.Thread(target=write, args=(path, size, chunk, barrier)) for path in paths]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    try:
+        extents = sum(count_extents(path) for path in paths) / concurrency
+    except OSError:
+        extents = float("nan")
+    finally:
+        for path in paths:
+            os.remove(path)
+    return concurrency * size / elapsed / 1e6, extents
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", default="/tmp/files")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1], help="GiB per upload")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--chunk", type=int, default=64, help="KiB per write, like a request.stream() chunk")
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    chunk = os.urandom(args.chunk * 1024)
+    for size_gib in args.sizes:
+        size = int(size_gib * 1024**3)
+        for mode in ("append", "fallocate"):
+            mbps, extents = bench(mode, args.dir, size, args.concurrency, chunk)
+            print(f"{size_gib:>6g} GiB x{args.concurrency} {mode:<10} {mbps:10.1f} MB/s  {extents:10.1f} extents/file")
+
+
+if __name__ == "__main__":
+    main()
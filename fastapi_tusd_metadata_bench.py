@@ -0,0 +1,133 @@
+"""
+Usage:
+python fastapi_tusd_metadata_bench.py --uploads 100000 --heads 20000 --backend memory
+
+Description:
+Per-upload memory and HEAD throughput of `fastapi_tusd.py` with many live uploads.
+
+- memory: bytes per `FileMetadata` record measured with `tracemalloc`, compared with the pydantic model it replaced
+- HEAD: the metadata store is filled with `--uploads` records, then `--heads` HEAD requests on random uploads are sent
+  in-process through `httpx.ASGITransport`, so the numbers exclude the network and uvicorn
+
+`--backend` is the `TUS_METADATA_BACKEND` to measure, records are written to `files_dir` of `fastapi_tusd.py`.
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+import tracemalloc
+from typing import Any, Hashable
+
+import httpx
+
+tus_version = "1.0.0"
+
+
+def record_kwargs(i: int) -> dict:
+    return dict(
+        uuid=f"{i:032x}",
+        upload_length=10 * 1024**3,
+        created_at="2023-01-01 00:00:00.000000",
+        defer_length=False,
+        expires="2023-01-02T00:00:00.000000",
+        offset=i * 1024,
+    )
+
+
+def measure_memory(build, n: int) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = [build(i) for i in range(n)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(records) == n
+    return (after - before) / n
+
+
+def legacy_builder():
+    """The pydantic model `FileMetadata` used to be, `None` if pydantic is not installed"""
+    try:
+        from pydantic import BaseModel
+    except ImportError:
+        return None
+
+    class LegacyFileMetadata(BaseModel):
+        uuid: str
+        upload_metadata: dict[Hashable, str]
+        upload_length: int
+        offset: int = 0
+        upload_part: int = 0
+        created_at: str
+        defer_length: bool
+        upload_chunk_size: int = 0
+        expires: str | None
+
+    metadata: dict[Any, str] = {"filename": "video.mp4", "filetype": "video/mp4"}
+    return lambda i: LegacyFileMetadata(upload_metadata=dict(metadata), **record_kwargs(i))
+
+
+async def run_heads(tusd, uuids: list[str], n: int, concurrency: int) -> float:
+    transport = httpx.ASGITransport(app=tusd.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://tusd") as client:
+
+        async def worker(count: int):
+            for _ in range(count):
+                r = await client.head(f"/files/{random.choice(uuids)}", headers={"Tus-Resumable": tus_version})
+                assert r.status_code == 200, r.status_code
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(n // concurrency) for _ in range(concurrency)))
+        return (n // concurrency * concurrency) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uploads", type=int, default=100_000)
+    parser.add_argument("--heads", type=int, default=20_000)
+    parser.add_argument("--sample", type=int, default=1000, help="uploads HEAD is sent to, each gets a file")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--backend", default="memory")
+    args = parser.parse_args()
+
+    os.environ["TUS_METADATA_BACKEND"] = args.backend
+    import fastapi_tusd as tusd
+
+    def build(i: int):
+        kwargs = record_kwargs(i)
+        offset = kwargs.pop("offset")
+        meta = tusd.FileMetadata.from_request(
+            upload_metadata={"filename": "video.mp4", "filetype": "video/mp4"}, **kwargs
+        )
+        meta.offset = offset
+        return meta
+
+    print(f"FileMetadata:        {measure_memory(build, args.uploads):8.0f} bytes/upload")
+    legacy = legacy_builder()
+    if legacy is not None:
+        print(f"pydantic (previous): {measure_memory(legacy, args.uploads):8.0f} bytes/upload")
+
+    prefix = f"bench{os.getpid():x}"
+    uuids = [f"{prefix}{i:024x}" for i in range(args.uploads)]
+    for uuid in uuids:
+        meta = build(0)
+        meta.uuid = uuid
+        tusd.metadata_store.put(meta)
+    sample = random.sample(uuids, min(args.sample, len(uuids)))
+    for uuid in sample:
+        os.makedirs(os.path.dirname(tusd._file_path(uuid)), exist_ok=True)
+        open(tusd._file_path(uuid), "a").close()
+
+    try:
+        rps = asyncio.run(run_heads(tusd, sample, args.heads, args.concurrency))
+        print(f"HEAD with {args.uploads} uploads ({args.backend}): {rps:8.0f} req/s")
+    finally:
+        for uuid in uuids:
+            tusd.metadata_store.delete(uuid)
+        for uuid in sample:
+            os.remove(tusd._file_path(uuid))
+        tusd.metadata_store.close()
+
+
+if __name__ == "__main__":
+    main()
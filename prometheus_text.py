@@ -0,0 +1,50 @@
+"""
+Description:
+Prometheus text exposition format for the `/metrics` endpoints of `fastapi_tusd.py`, `fastapi_resumable_upload.py`
+and `fastapi_streaming_llm.py`.
+
+`MetricsText` collects the metric families of one scrape, `render()` joins them:
+
+    text = MetricsText()
+    text.metric("tus_uploads_completed_total", "counter", "Uploads finished", 3)
+    text.rates("tus_upload_bytes_per_second", "Receive rate of each PATCH in progress", "uuid", active)
+    body = text.render()
+"""
+import time
+from typing import Any
+
+
+class MetricsText:
+    def __init__(self):
+        self.lines: list[str] = []
+
+    def metric(self, name: str, kind: str, help: str, value: float | list[tuple[str, float]]):
+        """One family, `value` is a single sample or a list of `(labels, value)`, `labels` like `{uuid="..."}`"""
+        samples = value if isinstance(value, list) else [("", value)]
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        self.lines.extend(f"{name}{labels} {sample}" for labels, sample in samples)
+
+    def rates(self, name: str, help: str, label: str, active: dict[Any, list]):
+        """Gauge of the rate per second of each item in progress, `active` maps the label to `[started at, count]`
+
+        `started at` is a `time.monotonic()` timestamp.
+        """
+        now = time.monotonic()
+        samples = [
+            (f'{{{label}="{key}"}}', count / max(now - started, 1e-6)) for key, (started, count) in active.items()
+        ]
+        self.metric(name, "gauge", help, samples)
+
+    def histogram(self, name: str, help: str, bounds: list[float], counts: list[int], total: float):
+        """`counts` has one (non-cumulative) count per upper bound in `bounds`, plus the last one for `+Inf`"""
+        samples, cumulative = [], 0
+        for le, count in zip(bounds + ["+Inf"], counts):
+            cumulative += count
+            samples.append((f'_bucket{{le="{le}"}}', cumulative))
+        samples.append(("_sum", total))
+        samples.append(("_count", cumulative))
+        self.metric(name, "histogram", help, samples)
+
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
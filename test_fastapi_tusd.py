@@ -0,0 +1,78 @@
+"""
+Usage:
+python -m pytest -q test_fastapi_tusd.py
+"""
+import asyncio
+import os
+import time
+import zlib
+
+import httpx
+
+import fastapi_tusd as tusd
+
+
+def test_checkpoints_match_written_bytes_with_slow_writer(monkeypatch):
+    """Every stored `(offset, checksum_crc32)` covers the same bytes, while a slow write is still hashing the next"""
+    block = 64 * 1024
+    body = os.urandom(block * 8 + 123)
+    checkpoints = []
+
+    write = tusd.FileSink.write
+
+    def slow_write(self, data, offset):
+        time.sleep(0.02)
+        write(self, data, offset)
+
+    upload_write = tusd.UploadWriter.write
+
+    async def busy_loop_write(self, chunk):
+        # The event loop serves other requests before the checkpoint, the disk thread hashes the next block meanwhile
+        await upload_write(self, chunk)
+        await asyncio.sleep(0.005)
+
+    write_metadata = tusd._write_metadata
+
+    def record_metadata(meta, durable=False):
+        checkpoints.append((meta.offset, meta.checksum_crc32))
+        write_metadata(meta, durable)
+
+    monkeypatch.setattr(tusd.FileSink, "write", slow_write)
+    monkeypatch.setattr(tusd.UploadWriter, "write", busy_loop_write)
+    monkeypatch.setattr(tusd.storage, "block_size", block)
+    monkeypatch.setattr(tusd, "metadata_checkpoint_bytes", block)
+    monkeypatch.setattr(tusd, "_write_metadata", record_metadata)
+
+    async def chunks():
+        for i in range(0, len(body), block):
+            yield body[i : i + block]
+
+    async def upload():
+        headers = {"Tus-Resumable": tusd.tus_version}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=tusd.app), base_url="http://tusd") as client:
+            # Longer than the body, so the upload stays unfinished
+            r = await client.post("/files", headers={**headers, "Upload-Length": str(len(body) * 2)})
+            assert r.status_code == 201
+            uuid = r.headers["Location"].rsplit("/", 1)[1]
+            checkpoints.clear()
+            r = await client.patch(
+                f"/files/{uuid}",
+                content=chunks(),
+                headers={
+                    **headers,
+                    "Upload-Offset": "0",
+                    "Content-Length": str(len(body)),
+                    "Content-Type": "application/offset+octet-stream",
+                },
+            )
+            assert r.status_code == 204
+            assert r.headers["Upload-Offset"] == str(len(body))
+            await client.delete(f"/files/{uuid}", headers=headers)
+
+    asyncio.run(upload())
+
+    # The intermediate checkpoints and the final one
+    assert len(checkpoints) > 2
+    for offset, crc32 in checkpoints:
+        assert crc32 == zlib.crc32(body[:offset]), offset
+    assert checkpoints[-1][0] == len(body)
@@ -0,0 +1,128 @@
+"""
+Description:
+Bandwidth shaping and per-client upload limits shared by `fastapi_tusd.py` and `fastapi_resumable_upload.py`.
+
+- `UploadShaper.slot(client)` admits at most `client_uploads` concurrent uploads per client, the next one is rejected
+  with `TooManyUploads` (the servers answer `429 Too Many Requests`) instead of queueing on the disk
+- `UploadShaper.throttle(client, size)` is awaited for every chunk of `request.stream()`: it takes `size` tokens from
+  the client's bucket (`client_rate` bytes/s) and then from the global bucket (`rate` bytes/s)
+
+Waiters of a bucket are served in FIFO order one chunk at a time, so concurrent uploads share the rate round-robin
+and a small upload is never stuck behind a large one. Without limits (`0`) `throttle` returns at once.
+
+Every worker process has its own buckets, divide the rates by the number of workers.
+"""
+import asyncio
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from prometheus_text import MetricsText
+
+
+class TooManyUploads(Exception):
+    def __init__(self, client: str, limit: int):
+        super().__init__(f"{client} already has {limit} uploads in progress")
+        self.client = client
+        self.limit = limit
+
+
+class TokenBucket:
+    """`rate` bytes/s with bursts up to `burst` bytes, a chunk larger than the tokens left goes into debt"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # `asyncio.Lock` wakes its waiters in FIFO order
+        self.lock = asyncio.Lock()
+
+    async def consume(self, size: int) -> float:
+        """Take `size` tokens, return the seconds spent waiting for them"""
+        started = time.monotonic()
+        async with self.lock:
+            self._refill()
+            if self.tokens < size:
+                await asyncio.sleep((size - min(self.tokens, size)) / self.rate)
+                self._refill()
+            self.tokens -= size
+        return time.monotonic() - started
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class UploadShaper:
+    """Limits of one upload server, and the counters for its `/metrics`
+
+    Only used from the event loop thread, so plain attributes are enough.
+    """
+
+    def __init__(self, rate: float = 0, client_rate: float = 0, client_uploads: int = 0, burst_seconds: float = 0.1):
+        self.rate = rate
+        self.client_rate = client_rate
+        self.client_uploads = client_uploads
+        self.burst_seconds = burst_seconds
+        self.bucket = TokenBucket(rate, rate * burst_seconds) if rate else None
+        self.client_buckets: dict[str, TokenBucket] = {}
+        self.active: defaultdict[str, int] = defaultdict(int)
+        self.throttled_seconds = 0.0
+        self.throttled_chunks = 0
+        self.rejected_uploads = 0
+
+    @contextmanager
+    def slot(self, client: str):
+        """Count an upload of `client` while the block runs, raise `TooManyUploads` over `client_uploads`"""
+        if self.client_uploads and self.active[client] >= self.client_uploads:
+            self.rejected_uploads += 1
+            raise TooManyUploads(client, self.client_uploads)
+        self.active[client] += 1
+        try:
+            yield
+        finally:
+            self.active[client] -= 1
+            if not self.active[client]:
+                del self.active[client]
+                # Drop the idle bucket, a new upload starts with a full burst anyway
+                self.client_buckets.pop(client, None)
+
+    async def throttle(self, client: str, size: int):
+        if not size or not (self.rate or self.client_rate):
+            return
+        waited = 0.0
+        if self.client_rate:
+            bucket = self.client_buckets.get(client)
+            if bucket is None:
+                bucket = self.client_buckets[client] = TokenBucket(
+                    self.client_rate, self.client_rate * self.burst_seconds
+                )
+            waited += await bucket.consume(size)
+        if self.bucket is not None:
+            waited += await self.bucket.consume(size)
+        if waited > 0.001:
+            self.throttled_seconds += waited
+            self.throttled_chunks += 1
+
+    def render(self, prefix: str) -> str:
+        """The counters in the Prometheus text format, named `<prefix>_...`"""
+        text = MetricsText()
+        text.metric(
+            f"{prefix}_throttled_seconds_total",
+            "counter",
+            "Time upload chunks waited for bandwidth",
+            self.throttled_seconds,
+        )
+        text.metric(
+            f"{prefix}_throttled_chunks_total",
+            "counter",
+            "Upload chunks delayed by the bandwidth limits",
+            self.throttled_chunks,
+        )
+        text.metric(
+            f"{prefix}_rejected_uploads_total", "counter", "Uploads over the per-client limit", self.rejected_uploads
+        )
+        text.metric(f"{prefix}_shaped_clients", "gauge", "Clients with uploads in progress", len(self.active))
+        return text.render()